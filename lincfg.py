@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 
-import sys, os, subprocess, shlex, shutil, tempfile, re, urllib.request, base64
-import textwrap, inspect, json, stat, socket, hashlib, configparser, site, glob
-import pprint, errno, time, functools, pwd, fnmatch, signal
+import time
+startup_times = {'start': time.perf_counter()}
+
+# NB: http.client is imported where it is used, it (and the email package it
+#     pulls in) accounts for a large share of the import time
+import sys, os, subprocess, shlex, shutil, tempfile, re, textwrap, json, stat
+import socket, hashlib, site, glob, pprint, errno, functools, pwd, fnmatch
+import signal, threading, resource, mmap, tarfile, fcntl, filecmp, urllib.parse
+
+startup_times['imported'] = time.perf_counter()
 
 desired_username = 'Liz'
 desired_wheel_users = ('Liz',)
@@ -12,10 +19,77 @@ desired_home = os.path.join(home_root, desired_username)
 
 tasks = []
 prereqs = {}
+
+# Tasks registered via prereq_task only wait for the tasks named in p (plus the
+# nearest preceding @tasks.append task) and may run alongside each other when
+# --parallel is set. Plain @tasks.append tasks still act as barriers.
 def prereq_task(*p):
   return lambda f: (tasks.append(f), prereqs.setdefault(f, p))
 
+# Network-bound tasks are prereq_task tasks which, with --overlap, don't wait
+# for the preceding barrier either. They start once the startup tasks and their
+# named prereqs are done and keep running alongside the local tasks after them.
+# A later task that needs their results declares it with after_network().
+network_tasks = {}
+network_dependents = {}
+startup_tasks = set()
+
+def network_task(*p):
+  return lambda f: (prereq_task(*p)(f), network_tasks.setdefault(f, p))
+
+def after_network(*p):
+  def decorator(f):
+    network_dependents.setdefault(f, p)
+    return f
+  return decorator
+
+def startup_task(idx):
+  return lambda f: (tasks.insert(idx, f), startup_tasks.add(f))
+
+# Tags let --only/--skip/--preset pick tasks by area. Every task has at least
+# one, anything that can touch the network is tagged network (network tasks
+# always are) and slow housekeeping is tagged maintenance.
+task_tags = {}
+
+def tagged(*tags):
+  def decorator(f):
+    task_tags.setdefault(f, set()).update(tags)
+    return f
+  return decorator
+
+def get_task_tags(task):
+  return task_tags.get(task, set()) | ({'network'} if task in network_tasks else set())
+
+# Tasks which prompt on stdin hold prompt_lock for as long as they run, as does
+# alert(), so with --overlap a background task's prompt waits for them instead
+# of racing them for input
+prompt_lock = threading.RLock()
+interactive_tasks = set()
+
+def interactive_task(f):
+  interactive_tasks.add(f)
+  return f
+
+# System queries wrapped with run_cached are answered from memory for the rest
+# of the run. Tasks that change the underlying state call invalidate() with the
+# matching tags so only the stale entries get recomputed.
+run_caches = {}
+
+def run_cached(*tags):
+  def decorator(f):
+    cached = functools.cache(f)
+    for tag in tags:
+      run_caches.setdefault(tag, []).append(cached)
+    return cached
+  return decorator
+
+def invalidate(*tags):
+  for tag in tags:
+    for cached in run_caches.get(tag, ()):
+      cached.cache_clear()
+
 @tasks.append
+@tagged('system')
 def ensure_user_exists():
   if is_termux():
     return
@@ -32,6 +106,16 @@ flag_def = [
   ('--undesired',   '-r', 'Interactively removes any undesired packages.'),
   ('--fpoverrides', '-f', 'Reset non-lincfg system-level flatpak permission'),
   ('--offline',     '-o', 'Skips any sections that require the internet'),
+  ('--parallel',    '-p', 'Run independent tasks concurrently (see LINCFG_JOBS)'),
+  ('--profile',     '-P', 'Show the slowest tasks compared to previous runs'),
+  ('--incremental', '-I', 'Skip managed files unchanged since the last run'),
+  ('--overlap',     '-O', 'Run network tasks in the background alongside local ones'),
+  ('--startup-profile', '-S', 'Show how long lincfg took to get to its first task'),
+  ('--only',        '', 'Only run the given comma separated task names or tags'),
+  ('--skip',        '', 'Skip the given comma separated task names or tags'),
+  ('--preset',      '', 'Run a preset selection of tasks: quick, full or scan'),
+  ('--fleet',       '', 'Run this lincfg with the other flags on every fleet host'),
+  ('--fleet-report', '', 'Print a machine readable result line (used by --fleet)'),
   ('--help',        '-h', 'Show this help screen'),
 ]
 
@@ -42,6 +126,7 @@ swap_file_2_path = '/var/swapfile2'
 swap_file_2_cmd = ('swapon', swap_file_2_path)
 
 @tasks.append
+@tagged('system')
 def ensure_swap_file_enabled_if_present():
   if not os.path.isfile(swap_file_path):
     return
@@ -126,6 +211,7 @@ def get_desired_packages(include_aur = False):
 
 packages_before_update = []
 @tasks.append
+@tagged('packages', 'network')
 def install_or_update_packages():
   if not packages_before_update:
     packages_before_update.extend(get_installed_packages())
@@ -145,6 +231,7 @@ def install_or_update_packages():
     )
   if is_fedora():
     subprocess.check_call(['dnf', 'install', '-y'] + get_desired_packages())
+  invalidate('packages')
 
 alpine_testing_repo = 'http://dl-cdn.alpinelinux.org/alpine/edge/community'
 alpine_testing_packages = {
@@ -155,6 +242,7 @@ alpine_testing_packages = {
 }
 
 @tasks.append
+@tagged('packages', 'network')
 def handle_testing_packages():
   if not is_postmarketos():
     return
@@ -166,6 +254,7 @@ def handle_testing_packages():
     return
   cmd = ['apk', 'add', f'--repository={alpine_testing_repo}']
   subprocess.run(cmd + packages_to_install, check = True, input = b'Y\n')
+  invalidate('packages')
 
 desired_timezone = 'US/Pacific'
 # desired_timezone = 'US/Arizona'
@@ -175,6 +264,7 @@ localtime_path = '/etc/localtime'
 desired_parent_timezone = 'US/Arizona'
 
 @tasks.append
+@tagged('system')
 def ensure_correct_timezone_set():
   if is_termux():
     return
@@ -187,6 +277,7 @@ def ensure_correct_timezone_set():
 
 locales_to_uncomment = ['en_US.UTF-8']
 @tasks.append
+@tagged('system')
 def ensure_correct_locales_generated():
   if not is_arch_linux():
     return
@@ -199,6 +290,7 @@ def ensure_correct_locales_generated():
 
 target_lang = 'en_US.UTF-8'
 @tasks.append
+@tagged('system')
 def ensure_correct_language_set():
   if is_termux():
     return
@@ -212,6 +304,7 @@ def ensure_correct_language_set():
 
 target_keymap = 'us'
 @tasks.append
+@tagged('system')
 def ensure_correct_keymap_set():
   if is_termux():
     return
@@ -225,6 +318,7 @@ def ensure_correct_keymap_set():
 
 esp_mountpoint = '/efi'
 @tasks.append
+@tagged('system')
 def ensure_esp_mountpoint_exists():
   if is_termux() or is_postmarketos():
     return
@@ -235,6 +329,7 @@ def ensure_esp_mountpoint_exists():
 
 desired_shell = 'bash'
 @tasks.append
+@tagged('system')
 def ensure_desired_shell_set():
   shell = which(desired_shell)
   users = {desired_username, 'root'}
@@ -511,17 +606,20 @@ fi
 
 }
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def make_and_update_small_scripts():
   if is_recovery():
     return
   for path, code in (small_scripts | global_small_scripts).items():
     code = code.lstrip()
+    if is_managed_file_unchanged(path, code):
+      continue
     p, existing_code = read_config(path, default_contents = '')
     if existing_code != code:
       u = desired_username if path.startswith(f'~{desired_username}') else None
-      write_config(p, code, user = u)
-      os.chmod(p, OWNER_CAN_RWX if path in small_scripts else ANYONE_CAN_RX)
+      write_config(p, code, user = u,
+                   perms = OWNER_CAN_RWX if path in small_scripts else ANYONE_CAN_RX)
 
 global_resources = {
 
@@ -551,16 +649,18 @@ Type=Application
 
 }
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def make_and_update_resources():
   if is_recovery():
     return
   for path, desired_contents in global_resources.items():
     desired_contents = desired_contents.lstrip()
+    if is_managed_file_unchanged(path, desired_contents):
+      continue
     p, existing_contents = read_config(path, default_contents = '')
     if existing_contents != desired_contents:
-      write_config(p, desired_contents)
-      os.chmod(p, ANYONE_CAN_R)
+      write_config(p, desired_contents, perms = ANYONE_CAN_R)
 
 @functools.cache
 def get_bashrc_skel():
@@ -571,7 +671,8 @@ def get_bashrc_skel():
 def get_desired_user_bashrc():
   return get_bashrc_skel() + desired_user_bashrc_suffix
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def ensure_bashrc_is_correct():
   d = None if is_arch_linux() else ''
   p, user_bashrc = read_config(user_bashrc_path, default_contents = d)
@@ -579,6 +680,7 @@ def ensure_bashrc_is_correct():
     write_config(p, get_desired_user_bashrc(), user = desired_username)
 
 @tasks.append
+@tagged('files')
 def ensure_xdg_local_bin_exists():
   makedirs(f'~{desired_username}/.local/bin', user = desired_username)
 
@@ -795,17 +897,20 @@ exec systemctl restart --user plasma-powerdevil
 # ''',
 }
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def ensure_shell_shims_exist():
   if is_recovery():
     return
   for name, desired_shim_code in user_shell_shims.items():
     desired_shim_code = desired_shim_code.lstrip()
-    p, shim_code = read_config(f'~{desired_username}/.local/bin/'+name,
-                              default_contents='')
+    path = f'~{desired_username}/.local/bin/'+name
+    if is_managed_file_unchanged(path, desired_shim_code):
+      continue
+    p, shim_code = read_config(path, default_contents='')
     if shim_code != desired_shim_code:
-      write_config(p, desired_shim_code, user = desired_username)
-      os.chmod(p, OWNER_CAN_RWX)
+      write_config(p, desired_shim_code, user = desired_username,
+                   perms = OWNER_CAN_RWX)
 
 desired_root_bashrc_suffix = f"""
 export LESS=-i
@@ -821,7 +926,8 @@ alias bt_dualboot="python -Bm bt_dualboot"
 def get_desired_root_bashrc():
   return get_bashrc_skel() + desired_root_bashrc_suffix
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def ensure_root_bashrc_is_correct():
   if is_termux():
     return
@@ -867,7 +973,8 @@ ALL ALL=(root) NOPASSWD: /usr/bin/emergency-signed-run
 # %wheel ALL=(root) NOPASSWD: /root/.local/bin/krdp-helper Alice
 '''.lstrip()
 
-@tasks.append
+@prereq_task()
+@tagged('security')
 def ensure_sudo_is_configured_correctly():
   if is_termux() or not (sudo := which('sudo')):
     return
@@ -886,7 +993,8 @@ doas_drop_in = r'''
 permit nopass :users as root cmd /usr/bin/emergency-signed-run args
 '''.lstrip()
 
-@tasks.append
+@prereq_task()
+@tagged('security')
 def ensure_doas_is_configured_correctly():
   if not which('doas'):
     return
@@ -901,7 +1009,8 @@ PasswordAuthentication no
 
 sshd_drop_in_path = '/etc/ssh/sshd_config.d/99-lincfg.conf'
 
-@tasks.append
+@prereq_task()
+@tagged('security')
 def ensure_sshd_is_configured():
   if not which('sshd'):
     return
@@ -924,7 +1033,8 @@ def get_desired_plasma_startup_script():
     script += arch_linux_desired_plasma_vars
   return script
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def ensure_plasma_vars_are_set_correctly():
   if not which('plasmashell'):
     return
@@ -1082,7 +1192,8 @@ rc_values_to_ensure = {
   ),
 }
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def ensure_rc_values_set():
   if not which('plasmashell'):
     return
@@ -1131,7 +1242,8 @@ plasma_desktop_rc = {
   },
 }
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def ensure_plasma_desktop_setup():
   p, src = read_config(plasma_applet_src_path, default_contents = '')
   sections = {}
@@ -1140,18 +1252,15 @@ def ensure_plasma_desktop_setup():
       plasma_desktop_rc['taskbar_pins']['values']['launchers']
         .replace('org.mozilla.firefox', 'firefox')
     )
+  doc = RcDocument(src)
   for k,v in plasma_desktop_rc.items():
-    isection = None
-    for line in src.splitlines():
-      if line.startswith('['):
-        isection = line
-      elif line == v['kv']:
-        sections[k] = isection
-  values = []
+    if found := doc.find_sections(*v['kv'].split('=', 1)):
+      sections[k] = found[-1]
   for k, section in sections.items():
-    values += [(section + plasma_desktop_rc[k].get('suffix', ''), *i)
-               for i in plasma_desktop_rc[k]['values'].items()]
-  ensure_rc_values_with_cache(p, src, values, user = desired_username)
+    for key, value in plasma_desktop_rc[k]['values'].items():
+      doc.set(section + plasma_desktop_rc[k].get('suffix', ''), key, value)
+  if (desired_src := doc.text()) != src:
+    write_config(p, desired_src, user = desired_username)
 
 touchpad_settings = {
   'NaturalScroll': 'true',
@@ -1165,7 +1274,8 @@ gamepadify_input_settings = {
   'ScrollFactor': '0.1',
 }
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def ensure_input_configured():
   if not which('plasmashell'):
     return
@@ -1216,70 +1326,21 @@ fsplevelrule=2
 '''
 }
 
-def get_rc_section(rc, name):
-  offset = 0
-  while True:
-    start = rc.find(name, offset)
-    if start < 0:
-      return None
-    if start == 0:
-      break
-    if rc[start-1] == '\n':
-      break
-    offset = start + 1
-  end = rc.find('\n[', start)
-  if end < 0:
-    return rc[start:].strip()
-  return rc[start:end-1].strip()
-
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def update_kwin_rules():
   if not which('plasmashell'):
     return
   p, rc = read_config(f'~{desired_username}/.config/kwinrulesrc',
                       default_contents = '')
-  desired_rc = rc
-  general_section = get_rc_section(rc, '[General]')
-  try:
-    count_val = re.search(r'count=\d+', general_section).group(0)
-  except (TypeError, AttributeError):
-    count_val = None
-  try:
-    rules_val = re.search(r'rules=.+', general_section).group(0)
-    rule_set = set(rules_val[6:].split(',')) if len(rules_val) > 6 else set()
-  except (TypeError, AttributeError):
-    rules_val = None
-    rule_set = set()
+  doc = RcDocument(rc)
+  rule_set = set(filter(None, (doc.get('[General]', 'rules') or '').split(',')))
   for name, values in kwin_rules.items():
-    desired_section = f'[{name}]\n{values.strip()}'
-    section = get_rc_section(rc, f'[{name}]')
-    if desired_section != section:
-      if section:
-        desired_rc = desired_rc.replace(section, desired_section)
-      else:
-        desired_rc += '\n' + desired_section + '\n'
+    doc.set_section(f'[{name}]', values.strip().splitlines())
     rule_set.add(name)
-  if general_section:
-    desired_general_section = general_section
-  else:
-    desired_general_section = '[General]'
-  desired_count_val = f'count={len(rule_set)}'
-  if count_val:
-    desired_general_section = (desired_general_section
-                               .replace(count_val, desired_count_val))
-  else:
-    desired_general_section += '\n' + desired_count_val
-  desired_rules_val = f'rules={','.join(sorted(rule_set))}'
-  if rules_val:
-    desired_general_section = (desired_general_section
-                               .replace(rules_val, desired_rules_val))
-  else:
-    desired_general_section += '\n' + desired_rules_val
-  if general_section:
-    desired_rc = desired_rc.replace(general_section, desired_general_section)
-  else:
-    desired_rc += '\n' + desired_general_section + '\n'
-  if desired_rc != rc:
+  doc.set('[General]', 'count', str(len(rule_set)))
+  doc.set('[General]', 'rules', ','.join(sorted(rule_set)))
+  if (desired_rc := doc.text()) != rc:
     write_config(p, desired_rc, user = desired_username)
 
 dolphin_bookmarks_path = f'~{desired_username}/.local/share/dolphin/bookmarks.xml'
@@ -1346,7 +1407,8 @@ def update_bookmark_xbel(path, desired_bookmarks):
   if xbel != original_xbel:
     write_config(p, xbel, user = desired_username)
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def update_dolphin_bookmarks_and_places():
   if not which('plasmashell'):
     return
@@ -1474,12 +1536,13 @@ prbsync_cloud_path = '/Projects/PRBSync/prbsync.py'
 
 get_lincfg_bin_path = lambda: fixpath('$PREFIX/bin/lincfg' if is_termux() else '~root/.local/bin/lincfg')
 
-@lambda f: tasks.insert(0, f)
+@startup_task(0)
+@tagged('files')
 def ensure_lincfg_is_current():
   if not which('diffcp'):
     return
   lincfg_project['destination'] = get_lincfg_bin_path()
-  rc = diffcp_copy('lincfg', **lincfg_project)
+  rc = sync_projects({'lincfg': lincfg_project})['lincfg']
   if rc == 0:
     sys.exit(
       subprocess.run([lincfg_project['destination']] + sys.argv[1:]).returncode
@@ -1519,31 +1582,113 @@ sudo /usr/bin/python3 -I /root/.local/bin/persistent_tmux "$USER"
 tmux a -t persist
 '''.lstrip()
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def ensure_tm_is_setup_and_up_to_date():
   p, tm_code = read_config(f'~{desired_username}/.local/bin/tm',
                           default_contents='')
   if tm_code != desired_tm_code:
-    write_config(p, desired_tm_code, user = desired_username)
-    os.chmod(p, 0o755)
+    write_config(p, desired_tm_code, user = desired_username, perms = 0o755)
 
 @tasks.append
+@tagged('files')
 def ensure_user_files_with_exact_contents_are_correct():
   if not which('plasmashell'):
     return
   for path, desired_contents in user_files_with_exact_contents.items():
-    path = fixpath(path)
-    try:
-      with open(path, 'r') as f:
-        current_contents = f.read()
-    except FileNotFoundError:
-      current_contents = None
+    if is_managed_file_unchanged(path, desired_contents):
+      continue
+    p, current_contents = read_config(path, default_contents = '')
     if current_contents != desired_contents:
-      write_config(path, desired_contents, user = desired_username)
+      write_config(p, desired_contents, user = desired_username)
 
 lincfg_user_data_dir = f'~{desired_username}/.local/share/lincfg'
 lincfg_root_data_dir = f'~root/.local/share/lincfg'
 lincfg_secrets_path = os.path.join(lincfg_root_data_dir, 'secrets.toml')
+lincfg_local_data_dir = '~/.local/share/lincfg'
+
+def get_lincfg_data_path(name):
+  return os.path.join(fixpath(lincfg_local_data_dir), name)
+
+# State lincfg keeps between runs lives in JSON files in its data dir. Saves go
+# through a temp file and a rename so an interrupted run can't leave a
+# truncated file behind.
+def load_lincfg_json(name, default):
+  try:
+    with open(get_lincfg_data_path(name), 'r') as f:
+      return json.load(f)
+  except (OSError, json.JSONDecodeError):
+    return default
+
+def save_lincfg_json(name, obj):
+  path = get_lincfg_data_path(name)
+  try:
+    makedirs(os.path.dirname(path))
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path),
+                               prefix = '.' + name + '.')
+    try:
+      with open(fd, 'w') as f:
+        json.dump(obj, f)
+      os.replace(tmp, path)
+    except BaseException:
+      try:
+        os.remove(tmp)
+      except FileNotFoundError:
+        pass
+      raise
+  except OSError as e:
+    print(f'Unable to save {name}:', e)
+
+# Fingerprints of files with exact desired contents (small scripts, resources,
+# shims, ...) as of the last successful run. With --incremental a file is
+# skipped without being read when both its desired contents and its stat
+# signature still match the fingerprint.
+managed_file_fingerprints_name = 'managed_files.json'
+managed_files = {}
+
+@functools.cache
+def load_managed_file_fingerprints():
+  return load_lincfg_json(managed_file_fingerprints_name, {})
+
+def get_managed_file_fingerprint(p, digest):
+  try:
+    return [digest, *get_config_signature(os.stat(p))]
+  except FileNotFoundError:
+    return None
+
+def is_managed_file_unchanged(path, desired_contents):
+  p = fixpath(path)
+  digest = hashlib.sha256(desired_contents.encode()).hexdigest()
+  fingerprint = flags('incremental') and get_managed_file_fingerprint(p, digest)
+  skip = bool(fingerprint) and \
+         load_managed_file_fingerprints().get(p) == fingerprint
+  managed_files[p] = (digest, skip)
+  return skip
+
+# Only fingerprints files whose contents are known to match, either because
+# they were skipped and haven't changed since or because the config cache holds
+# the desired contents for their current signature
+def record_managed_file_fingerprints():
+  fingerprints = {}
+  for p, (digest, skipped) in managed_files.items():
+    fingerprint = get_managed_file_fingerprint(p, digest)
+    if fingerprint is None:
+      continue
+    if skipped:
+      if load_managed_file_fingerprints().get(p) == fingerprint:
+        fingerprints[p] = fingerprint
+      continue
+    entry = config_cache.get(p)
+    if entry and not entry['dirty'] and \
+       tuple(fingerprint[1:]) == entry['signature'] and \
+       hashlib.sha256(entry['contents'].encode()).hexdigest() == digest:
+      fingerprints[p] = fingerprint
+  save_lincfg_json(managed_file_fingerprints_name, fingerprints)
+
+def print_managed_file_report():
+  skipped = sum((1 for _, skip in managed_files.values() if skip))
+  print(f'\nManaged files: {skipped} skipped, '
+        f'{len(managed_files) - skipped} verified')
 
 @functools.cache
 def get_secrets():
@@ -1640,6 +1785,145 @@ MINIMAL_BUNDLE_EXCLUDED_PATTERNS = [
 
 bundle_root_name = 'lincfg_bundle'
 
+# Streams src into tar under arcname without staging a copy, following symlinks
+# like copytree did. Regular files with the same contents as one already
+# written under the same top-level bundle dir become hardlink members (found by
+# size, then sha256) so extracting a single top-level dir still works. Only
+# files with the same mode and owner are linked, as hardlinks share them.
+def add_to_bundle(tar, src, arcname, skip, seen):
+  def digest(path):
+    with open(path, 'rb') as f:
+      return hashlib.file_digest(f, 'sha256').hexdigest()
+  def add(path, name):
+    if name in skip:
+      return
+    info = tar.gettarinfo(path, name)
+    if info is None:
+      return
+    if not info.isreg():
+      return tar.addfile(info)
+    same_size = seen.setdefault((name.split('/')[:2][-1], info.size, info.mode,
+                                 info.uid, info.gid), [])
+    if info.size > 0 and same_size:
+      d = digest(path)
+      for other in same_size:
+        if other[2] is None:
+          other[2] = digest(other[1])
+        if other[2] == d:
+          info.type = tarfile.LNKTYPE
+          info.linkname = other[0]
+          info.size = 0
+          return tar.addfile(info)
+      same_size.append([name, path, d])
+    else:
+      same_size.append([name, path, None])
+    with open(path, 'rb') as f:
+      tar.addfile(info, f)
+  if not os.path.isdir(src):
+    return add(src, arcname)
+  for root, dirs, files in os.walk(src, followlinks = True):
+    dirs.sort()
+    rel = os.path.relpath(root, src)
+    rname = arcname if rel == os.path.curdir else arcname + '/' + rel
+    add(root, rname)
+    for i in sorted(files):
+      add(os.path.join(root, i), rname + '/' + i)
+
+# Writes a .tar.xz through a multi-threaded xz when available
+def open_bundle_archive(arc):
+  if not (xz := which('xz')):
+    return None, tarfile.open(arc, 'w|xz', dereference = True)
+  with open(arc, 'wb') as out:
+    proc = subprocess.Popen((xz, '-T0', '-c'), stdin = subprocess.PIPE,
+                            stdout = out)
+  return proc, tarfile.open(fileobj = proc.stdin, mode = 'w|',
+                            dereference = True)
+
+def close_bundle_archive(proc, tar):
+  tar.close()
+  if proc:
+    proc.stdin.close()
+    if proc.wait() != 0:
+      raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+# Drops a partially written archive without finalizing it
+def discard_bundle_archive(proc, tar, arc):
+  if proc:
+    proc.kill()
+  for f in (tar.fileobj, proc and proc.stdin):
+    try:
+      f and f.close()
+    except OSError:
+      pass
+  if proc:
+    proc.wait()
+  try:
+    os.remove(arc)
+  except FileNotFoundError:
+    pass
+
+FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+hydration_jobs = 8
+
+# NB: os.copy_file_range is missing on kernels/libcs without it (and off Linux)
+def copy_file_data(fsrc, fdst, size):
+  if hasattr(os, 'copy_file_range'):
+    try:
+      copied = 0
+      while copied < size:
+        if not (n := os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                        size - copied)):
+          break
+        copied += n
+      return
+    except OSError as e:
+      if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                         errno.EOPNOTSUPP, errno.EBADF):
+        raise
+  fsrc.seek(0)
+  fdst.seek(0)
+  fdst.truncate()
+  shutil.copyfileobj(fsrc, fdst, 4194304) # 4 MB
+
+# Reflinks src to dst when the filesystem supports it (e.g. btrfs), otherwise
+# copies in kernel via copy_file_range and only then through userspace. Mode,
+# times and ownership are applied on the open file in the same pass.
+def hydrate_file(src, dst, uid, gid):
+  with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+    st = os.fstat(fsrc.fileno())
+    try:
+      fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+      copy_file_data(fsrc, fdst, st.st_size)
+    fdst.flush()
+    os.fchown(fdst.fileno(), uid, gid)
+    os.fchmod(fdst.fileno(), stat.S_IMODE(st.st_mode))
+    os.utime(fdst.fileno(), ns = (st.st_atime_ns, st.st_mtime_ns))
+
+# Equivalent of copytree(src, dst, dirs_exist_ok = True) followed by
+# chown -R user: dst, with the files copied concurrently
+def hydrate_path(src, dst, user):
+  import concurrent.futures
+  pw = pwd.getpwnam(user)
+  dirs = []
+  with concurrent.futures.ThreadPoolExecutor(hydration_jobs) as ex:
+    futures = []
+    for root, dirnames, files in os.walk(src, followlinks = True):
+      droot = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+      os.makedirs(droot, exist_ok = True)
+      dirs.append((root, droot))
+      for i in files:
+        futures.append(ex.submit(hydrate_file,
+                                 os.path.join(root, i), os.path.join(droot, i),
+                                 pw.pw_uid, pw.pw_gid))
+    for future in futures:
+      future.result()
+  for root, droot in reversed(dirs):
+    st = os.stat(root)
+    os.chown(droot, pw.pw_uid, pw.pw_gid)
+    os.chmod(droot, stat.S_IMODE(st.st_mode))
+    os.utime(droot, ns = (st.st_atime_ns, st.st_mtime_ns))
+
 def try_get_bundle_root():
   bundle_root = os.path.abspath(os.path.join(__file__, *(4*(os.path.pardir,))))
   if os.path.basename(bundle_root) == bundle_root_name:
@@ -1647,6 +1931,7 @@ def try_get_bundle_root():
   return None
 
 @tasks.append
+@tagged('files')
 def handle_bundle_related_operations():
   secrets = fixpath(lincfg_secrets_path)
   if bundle_root := try_get_bundle_root():
@@ -1677,8 +1962,7 @@ def handle_bundle_related_operations():
         subprocess.check_call((btrfs_progs, 'subvolume', 'create', local_path))
       else:
         os.mkdir(local_path)
-      shutil.copytree(bundle_path, local_path, dirs_exist_ok = True)
-      subprocess.check_call(('chown', '-R', desired_username+':', local_path))
+      hydrate_path(bundle_path, local_path, desired_username)
     bundle_secrets = os.path.join(bundle_root, os.path.basename(secrets))
     shutil.copy(bundle_secrets, secrets)
   if dest := os.environ.get('LINCFG_BUNDLE_DEST'):
@@ -1703,19 +1987,17 @@ def handle_bundle_related_operations():
           paths_to_bundle.append(os.path.join(r, source))
     else:
       raise ValueError('Invalid bundle size: {}'.format(repr(bundle_size)))
+    flush_config_cache()
     pfx = fixpath(f'~{desired_username}') + os.path.sep
     st = os.stat(dest)
     os.mkdir(bundle_root := os.path.join(dest, bundle_root_name))
     os.chown(bundle_root, st.st_uid, st.st_gid)
-    for src in sorted(set(map(fixpath, paths_to_bundle))):
+    sources = sorted(set(map(fixpath, paths_to_bundle)))
+    for src in sources:
       if not src.startswith(pfx):
         raise RuntimeError(f'Unexpected path: {src}')
-      dest = os.path.join(bundle_root, src[len(pfx):])
-      makedirs(os.path.dirname(dest))
-      try:
-        shutil.copytree(src, dest)
-      except NotADirectoryError:
-        shutil.copy2(src, dest)
+    # NB: only the secrets and whatever make_bundle.sh adds are staged on disk
+    #     everything else is streamed straight from its source into the archive
     make_bundle_script = fixpath('~/.local/share/lincfg/make_bundle.sh')
     bundle_secrets = os.path.join(bundle_root, os.path.basename(secrets))
     shutil.copy2(secrets, bundle_secrets)
@@ -1724,9 +2006,27 @@ def handle_bundle_related_operations():
                              'LINCFG_BUNDLE_ROOT': bundle_root,
                              'LINCFG_BUNDLE_SIZE': bundle_size,
                            })
+    staged = set()
+    for root, dirs, files in os.walk(bundle_root):
+      for i in dirs + files:
+        staged.add(bundle_root_name + '/' +
+                   os.path.relpath(os.path.join(root, i), bundle_root))
     arc = bundle_root + '.tar.xz'
-    subprocess.check_call(('tar', 'cJf', arc, os.path.basename(bundle_root)),
-                          cwd = os.path.dirname(bundle_root))
+    partial_arc = arc + '.part'
+    proc, tar = open_bundle_archive(partial_arc)
+    try:
+      seen = {}
+      tar.addfile(tar.gettarinfo(bundle_root, bundle_root_name))
+      for src in sources:
+        add_to_bundle(tar, src, bundle_root_name + '/' + src[len(pfx):],
+                      staged, seen)
+      for i in sorted(os.listdir(bundle_root)):
+        tar.add(os.path.join(bundle_root, i), bundle_root_name + '/' + i)
+      close_bundle_archive(proc, tar)
+    except BaseException:
+      discard_bundle_archive(proc, tar, partial_arc)
+      raise
+    os.replace(partial_arc, arc)
     os.chown(arc, st.st_uid, st.st_gid)
     shutil.rmtree(bundle_root)
 
@@ -2255,7 +2555,8 @@ kate_external_tools_configs = [
 ]
 kate_external_tools_config_path = f'~{desired_username}/.local/share/kxmlgui5/externaltools/ui.rc'
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def ensure_kate_external_tools_setup():
   if not which('kate'):
     return
@@ -2282,7 +2583,8 @@ katepart_redo_tag = '<Action group="edit_operations" name="edit_redo"/>'
 katepart_reload_tag = '<Action name="file_reload"/>'
 katepart_config_path = f'~{desired_username}/.local/share/kxmlgui5/katepart/katepart5ui.rc'
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def ensure_katepart_setup():
   if not which('kate'):
     return
@@ -2488,10 +2790,13 @@ logout_users = true
 }
 
 @tasks.append
+@tagged('files')
 def ensure_system_files_with_exact_contents_are_up_to_date():
   if is_termux() or is_postmarketos() or is_recovery():
     return
   for path, desired_contents in system_files_with_exact_contents.items():
+    if is_managed_file_unchanged(path, desired_contents):
+      continue
     p, current = read_config(path, default_contents = '')
     if current != desired_contents:
       write_config(p, desired_contents)
@@ -2616,6 +2921,7 @@ Count=1
 }
 
 @tasks.append
+@tagged('files')
 def ensure_user_files_only_created_once_have_been_created():
   if is_recovery() or is_termux():
     return
@@ -2625,20 +2931,16 @@ def ensure_user_files_only_created_once_have_been_created():
       write_config(p, desired_contents, user = desired_username)
 
 @tasks.append
+@tagged('kde')
 def ensure_dolphin_is_configured():
-  desired_value = 'HiddenFilesShown=true'
   p, dolphin_props = read_config(f'~{desired_username}/.local/share/dolphin/view_properties/global/.directory', default_contents='')
-  if dolphin_props and desired_value not in dolphin_props:
-    current = get_config_var(dolphin_props, 'HiddenFilesShown')
-    if current != 'None':
-      dolphin_props.replace(current, desired_value)
-    elif '[Settings]' in dolphin_props:
-      dolphin_props.replace('[Settings]', '[Settings]\n'+desired_value)
-    else:
-      dolphin_props += '\n\n[Settings]\n'+desired_value
-    write_config(p, dolphin_props, user = desired_username)
+  if dolphin_props:
+    ensure_rc_values_with_cache(p, dolphin_props,
+                                (('[Settings]', 'HiddenFilesShown', 'true'),),
+                                user = desired_username)
 
-@tasks.append
+@prereq_task()
+@tagged('security')
 def ensure_limits_conf_setup():
   if is_termux():
     return
@@ -2654,7 +2956,8 @@ desired_login_def_cfgs = [
   'UMASK 027',
 ]
 
-@tasks.append
+@prereq_task()
+@tagged('security')
 def ensure_login_defs_setup():
   if is_termux():
     return
@@ -2679,7 +2982,8 @@ def ensure_login_defs_setup():
 
 sshd_config_path = '/etc/ssh/sshd_config'
 desired_sshd_config_mode = 0o600
-@tasks.append
+@prereq_task()
+@tagged('security')
 def ensure_sshd_config_has_desired_mode():
   try:
     if (os.stat(sshd_config_path).st_mode & 0o777) != desired_sshd_config_mode:
@@ -2717,6 +3021,7 @@ alpine_default_sysctl_cfg_path = '/usr/lib/sysctl.d/00-alpine.conf'
 fedora_default_sysctl_cfg_path = '/usr/lib/sysctl.d/99-lincfg.conf'
 
 @tasks.append
+@tagged('security')
 def ensure_sysctl_values_set():
   if is_termux():
     return
@@ -2752,7 +3057,8 @@ install rds /bin/true
 install tipc /bin/true
 '''
 
-@tasks.append
+@prereq_task()
+@tagged('security')
 def ensure_uncommon_protocols_blocked():
   if is_termux():
     return
@@ -2761,6 +3067,7 @@ def ensure_uncommon_protocols_blocked():
     write_config(p, target_protocols_modprobe_cfg)
 
 @tasks.append
+@tagged('files')
 def remove_egrep_warning():
   if not is_arch_linux():
     return
@@ -2773,6 +3080,7 @@ ufw_user_conf_path = '/etc/ufw/user.rules'
 sessen_port = 9292
 
 @tasks.append
+@tagged('security')
 def configure_ufw():
   if not (ufw := which('ufw')) or is_postmarketos():
     return
@@ -2810,6 +3118,7 @@ WantedBy=multi-user.target
 '''.lstrip()
 
 @tasks.append
+@tagged('services')
 def fix_keyd_config():
   pmos_generate_cros_keymap = which('pmos-generate-cros-keymap')
   if not pmos_generate_cros_keymap:
@@ -2826,6 +3135,7 @@ def fix_keyd_config():
   subprocess.check_call(('systemctl', 'enable', 'keyd', '--now'))
 
 @tasks.append
+@tagged('packages')
 def handle_python_version_updates():
   if os.path.isfile(os.__file__):
     return
@@ -2834,7 +3144,7 @@ def handle_python_version_updates():
   )).decode().strip()
   if new_site_packages == SYSTEM_SITE_PACKAGES:
     raise RuntimeError()
-  for url in desired_python_packages.keys():
+  for url, pkg_hash in desired_python_packages.items():
     dirname = url.rpartition('/')[2].rpartition('-')[0].replace('-','_')
     try:
       os.rename(
@@ -2842,16 +3152,23 @@ def handle_python_version_updates():
         os.path.join(new_site_packages, dirname),
       )
     except FileNotFoundError:
-      pass
+      if get_cached_python_package(pkg_hash):
+        install_python_package(url, pkg_hash, new_site_packages)
   os.rmdir(SYSTEM_SITE_PACKAGES)
   pydir = os.path.dirname(SYSTEM_SITE_PACKAGES)
   if 'python' not in pydir or '.' not in pydir:
     return
   os.rmdir(pydir)
 
-@tasks.append
+@network_task('handle_python_version_updates')
+@tagged('packages')
 def ensure_python_packages_updated():
   if not flags('offline'):
+    import concurrent.futures
+    pkgnames = [parse_python_package_url(url)[1]
+                for url in desired_python_packages.keys()]
+    with concurrent.futures.ThreadPoolExecutor(http_jobs) as ex:
+      list(ex.map(get_pypi_latest_version, pkgnames))
     for url, pkg_hash in desired_python_packages.items():
       ensure_python_package(url, pkg_hash)
 
@@ -2890,6 +3207,7 @@ def ensure_python_packages_updated():
 #     os.chmod(dst, 0o644)
 
 @tasks.append
+@tagged('files')
 def set_firefox_policies_in_container():
   if not in_container():
     return
@@ -2923,19 +3241,21 @@ github_repos_used_by_aur_packages = {
 
 out_of_date_aur_packages = {}
 
-@tasks.append
+@network_task('install_or_update_packages')
+@tagged('packages')
 def check_for_out_of_date_aur_packages():
   if not is_arch_linux():
     return
   if not flags('offline'):
+    installed_versions = dict((i.split(' ', 1) for i in get_installed_packages()))
     for package, repo in github_repos_used_by_aur_packages.items():
       if not which(package):
         continue
-      installed_version = re.findall(package+r'\s+(.+)', subprocess.check_output(['pacman', '-Q']).decode())[0]
+      installed_version = installed_versions[package]
       url = GITHUB_BASE_URL + repo + GITHUB_RELEASES_PATH
       latest_version = re.findall('/tree/(.+?)[\'|"]',
-                                  urllib.request.urlopen(url)
-                                    .read().decode())[0].replace('-', '.')
+                                  http_request(url)[2]
+                                    .decode())[0].replace('-', '.')
       current_version = installed_version.split('-')[0]
       if current_version != latest_version:
         out_of_date_aur_packages[package] = {
@@ -2948,6 +3268,8 @@ AUR_PACKAGE_BASE_URL = 'https://aur.archlinux.org/packages/'
 AURWEB_RPC_INFO_BASE_URL = 'https://aur.archlinux.org/rpc/v5/info?'
 
 @tasks.append
+@after_network('check_for_out_of_date_aur_packages')
+@tagged('packages')
 def warn_about_outdated_aur_packages():
   if not flags('interact') and len(out_of_date_aur_packages) > 0:
     url = AURWEB_RPC_INFO_BASE_URL + '&'.join(
@@ -2957,7 +3279,7 @@ def warn_about_outdated_aur_packages():
         'version': result['Version'].split('-')[0],
         'last_modified': result['LastModified'],
       }
-      for result in json.loads(urllib.request.urlopen(url).read())['results']
+      for result in json.loads(http_request(url)[2])['results']
     }
     for interactive in (False, True):
       for name, meta in out_of_date_aur_packages.items():
@@ -2988,6 +3310,8 @@ aur_packages_installed_via_aur_helper = [
 reasons_interactive_setup_needed = []
 
 @tasks.append
+@interactive_task
+@tagged('packages', 'network')
 def interactively_setup_aur_packages():
   if not flags('interact') or flags('offline') or not is_arch_linux():
     return
@@ -3024,6 +3348,7 @@ def interactively_setup_aur_packages():
         subprocess.run(['runuser', '-unobody', 'makepkg'], cwd=tdir, check=False)
         pkg = os.path.join(tdir, tuple(filter(lambda i: i.endswith('.tar.zst'), os.listdir(tdir)))[0])
         subprocess.run(['pacman', '-U', '--noconfirm', pkg])
+        invalidate('packages')
         shutil.rmtree(tdir)
 
     for package in aur_packages_installed_via_aur_helper:
@@ -3086,6 +3411,7 @@ def interactively_setup_aur_packages():
         inp = input('> ')
         if inp == 'BUILDOK':
           subprocess.check_call(('pacman', '-U', '--noconfirm', tdir_pkg_path))
+          invalidate('packages')
           subprocess.check_call(('podman',
                                 'exec',
                                 '-it',
@@ -3339,7 +3665,8 @@ gzip -f9 "files/maldet.1"
 install -D -m 644 "files/maldet.1.gz" "/usr/share/man/man1/maldet.1.gz"
 '''
 
-@tasks.append
+@network_task('install_or_update_packages')
+@tagged('packages', 'security')
 def ensure_maldet_installed_and_up_to_date():
   if flags('offline'):
     return
@@ -3351,33 +3678,29 @@ def ensure_maldet_installed_and_up_to_date():
   subprocess.run(get_shell(),
                  input = MALDET_SETUP_SCRIPT.encode(),
                  check = True)
+  which.cache_clear()
 
-maldet_functions_path = '/usr/share/maldet/internals/functions'
-original_maldext_size_limit_code = \
-  "scan_max_filesize=`cat $sig_md5_file | cut -d':' -f2 | sort -n | tail -n1`"
-patched_maldet_size_limit_code = 'scan_max_filesize=99999999999999999'
-
-@tasks.append
-def patch_maldet():
-  p, code = read_config(maldet_functions_path, default_contents = '')
-  if original_maldext_size_limit_code not in code:
-    return
-  code = code.replace(original_maldext_size_limit_code,
-                      patched_maldet_size_limit_code)
-  write_config(p, code)
+@run_cached('passwords')
+def get_password_status(user):
+  return subprocess.check_output(['passwd', '--status', user]).decode().split()[1]
 
 @tasks.append
+@interactive_task
+@tagged('security')
 def ensure_passwords_are_setup():
   for user in (desired_username, 'root'):
-    if subprocess.check_output(['passwd', '--status', user]).decode().split()[1] in ('NP','L'):
+    if get_password_status(user) in ('NP','L'):
       if flags('interact'):
         print('\nSetting up password for', user)
         subprocess.run(['passwd', user])
+        invalidate('passwords')
       else:
         print(user + ' needs to have a password set')
         reasons_interactive_setup_needed.append('password for ' + user)
 
 @tasks.append
+@interactive_task
+@tagged('network')
 def setup_rclone_and_maybe_prbsync():
   if flags('offline') or \
      not flags('interact') or \
@@ -3424,9 +3747,10 @@ def setup_rclone_and_maybe_prbsync():
     #                   local_cloud_drive_path, cloud_drive_name+':'])
 
 @tasks.append
+@tagged('packages')
 def check_if_interactive_setup_needed():
   if is_arch_linux():
-    packages_before_update_without_versions = set((shlex.split(i)[0] for i in packages_before_update))
+    packages_before_update_without_versions = set((i.split()[0] for i in packages_before_update))
     if any((package not in packages_before_update_without_versions
             for package in (i[0] for i in aur_packages))):
       reasons_interactive_setup_needed.append('missing aur package')
@@ -3440,6 +3764,7 @@ NO_EXECUTE_MASK = ~(stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
 
 # See CVE-2020-23922, CVE-2021-3575, etc - see notes below
 @tasks.append
+@tagged('security')
 def disable_risky_executables():
   for bin in ('gif2rgb', 'opj_compress', 'opj_decompress', 'opj_dump', 'heif-convert'):
     bin_path = which(bin)
@@ -3462,6 +3787,7 @@ def disable_risky_executables():
 #   subprocess.run(['chmod', '+x', p])
 
 @tasks.append
+@tagged('security')
 def patch_rkhunter_to_use_https_for_updates():
   rkhunter = which('rkhunter')
   if not rkhunter:
@@ -3480,6 +3806,7 @@ def patch_rkhunter_to_use_https_for_updates():
 rkhunter_dat_path = '/var/lib/rkhunter/db/rkhunter.dat'
 
 @tasks.append
+@tagged('security')
 def configure_rkhunter_and_update_props_if_stale():
   rkhunter = which('rkhunter')
   if not rkhunter:
@@ -3528,6 +3855,7 @@ container_disabled_lynis_tests = [
 ]
 
 @tasks.append
+@tagged('security')
 def configure_lynis():
   if not which('lynis'):
     return
@@ -3549,18 +3877,145 @@ unscanned_downloads_subdirs = ('JDownloader', 'Firefox')
 scanned_downloads_dir = os.path.join(user_downloads_dir, 'Scanned')
 maldet_dirs_to_skip = ('/sys',)
 maldet_scan_run_reasons = []
+maldet_sigs_version_relpath = os.path.join('sigs', 'maldet.sigs.ver')
+clamav_db_dir = '/var/lib/clamav'
+scan_ledger_name = 'scan_ledger.json'
+scan_ledger_length = 10000
+
+default_scan_jobs = 2
+scan_durations_name = 'scan_durations.json'
+
+# Runs maldet while echoing its output and returns the malware hits it reported
+# for the scan (None if it didn't report any)
+def run_maldet_scan(cmd, check = False, prefix = ''):
+  proc = subprocess.Popen(cmd, stdout = subprocess.PIPE,
+                          stderr = subprocess.STDOUT)
+  hits = None
+  for line in proc.stdout:
+    line = line.decode(errors = 'replace')
+    print(prefix + line, end = '', flush = True)
+    if m := re.search(r'malware hits (\d+)', line):
+      hits = int(m.group(1))
+  if proc.wait() != 0 and check:
+    raise subprocess.CalledProcessError(proc.returncode, cmd)
+  return hits
+
+# Identifies the maldet and ClamAV signatures in use so cached verdicts are
+# dropped whenever either gets updated
+def get_scan_signature_version(maldet):
+  maldet_root = os.path.dirname(os.path.realpath(maldet))
+  _, maldet_sigs_version = read_config(
+    os.path.join(maldet_root, maldet_sigs_version_relpath), default_contents = '')
+  if not maldet_sigs_version.strip():
+    return None
+  version = [maldet_sigs_version.strip()]
+  try:
+    with os.scandir(clamav_db_dir) as it:
+      for i in sorted(it, key = lambda i: i.name):
+        if i.name.endswith(('.cvd', '.cld')):
+          st = i.stat()
+          version.append((i.name, st.st_size, st.st_mtime_ns))
+  except FileNotFoundError:
+    pass
+  return hashlib.sha256(repr(version).encode()).hexdigest()
+
+def get_scan_jobs():
+  if jobs := os.environ.get('LINCFG_SCAN_JOBS', '').strip():
+    return max(1, int(jobs))
+  return default_scan_jobs
+
+def load_scan_durations():
+  return load_lincfg_json(scan_durations_name, {})
+
+# Roots that took longest last time start first. Roots without a previous
+# duration are assumed to be big and go before them, largest listing first.
+def get_maldet_scan_roots():
+  durations = load_scan_durations()
+  def estimate(p):
+    if p in durations:
+      return (0, durations[p])
+    try:
+      return (1, len(os.listdir(p)))
+    except OSError:
+      return (1, 0)
+  roots = [os.path.join('/', d) for d in os.listdir('/')]
+  roots = [p for p in roots if p not in maldet_dirs_to_skip]
+  return sorted(roots, key = estimate, reverse = True)
+
+# Scans each root with its own maldet process at idle I/O and CPU priority,
+# at most get_scan_jobs() at a time, and returns the hits each one reported
+def run_maldet_scans(maldet, roots):
+  import concurrent.futures
+  pfx = []
+  if ionice := which('ionice'):
+    pfx += [ionice, '-c3']
+  if nice := which('nice'):
+    pfx += [nice, '-n19']
+  durations = load_scan_durations()
+  def scan(p):
+    start = time.perf_counter()
+    hits = run_maldet_scan([*pfx, maldet, '-a', p], prefix = f'[{p}] ')
+    durations[p] = time.perf_counter() - start
+    return hits
+  try:
+    with concurrent.futures.ThreadPoolExecutor(get_scan_jobs()) as ex:
+      futures = {ex.submit(scan, p): p for p in roots}
+      return {futures[f]: f.result()
+              for f in concurrent.futures.as_completed(futures)}
+  finally:
+    save_lincfg_json(scan_durations_name, durations)
+
+def load_scan_ledger(version):
+  ledger = load_lincfg_json(scan_ledger_name, {})
+  if version is None or ledger.get('signatures') != version:
+    return {}
+  return ledger.get('clean', {})
+
+def record_clean_scans(version, clean, digests):
+  for digest in digests:
+    clean.pop(digest, None)
+    clean[digest] = cached_time()
+  for digest in list(clean)[:-scan_ledger_length]:
+    del clean[digest]
+  save_lincfg_json(scan_ledger_name, {'signatures': version, 'clean': clean})
+
+# NB: patch_maldet only changes how maldet scans, so the signature update
+#     doesn't wait for it
+@network_task('install_or_update_packages',
+              'ensure_maldet_installed_and_up_to_date')
+@tagged('security')
+def update_av_signatures():
+  if is_termux() or flags('offline'):
+    return
+  if freshclam := which('freshclam'):
+    subprocess.run(freshclam)
+  if maldet := which('maldet'):
+    subprocess.run([maldet, '--update-sigs'])
+
+maldet_functions_path = '/usr/share/maldet/internals/functions'
+original_maldext_size_limit_code = \
+  "scan_max_filesize=`cat $sig_md5_file | cut -d':' -f2 | sort -n | tail -n1`"
+patched_maldet_size_limit_code = 'scan_max_filesize=99999999999999999'
+
+@tasks.append
+@after_network('update_av_signatures')
+@tagged('security')
+def patch_maldet():
+  p, code = read_config(maldet_functions_path, default_contents = '')
+  if original_maldext_size_limit_code not in code:
+    return
+  code = code.replace(original_maldext_size_limit_code,
+                      patched_maldet_size_limit_code)
+  write_config(p, code)
 
 @tasks.append
+@after_network('update_av_signatures')
+@tagged('security')
 def update_av_if_online_then_do_scans():
   if is_termux():
     return
 
-  if not flags('offline') and which('freshclam'):
-    subprocess.run(which('freshclam'))
-
   maldet = which('maldet') # From https://aur.archlinux.org/packages/maldet
-  if maldet and not flags('offline'):
-    subprocess.run([maldet, '--update-sigs'])
 
   if flags('scan'):
     if in_container():
@@ -3574,12 +4029,11 @@ def update_av_if_online_then_do_scans():
     subprocess.run(shlex.split('lynis audit system'))
 
     if maldet:
-      for d in os.listdir('/'):
-        if (p := os.path.join('/', d)) in maldet_dirs_to_skip:
-          continue
-        subprocess.run([maldet, '-a', p])
-        maldet_scan_run_reasons.append('argument')
-        check_maldet_log()
+      for p, hits in run_maldet_scans(maldet, get_maldet_scan_roots()).items():
+        if hits is None:
+          maldet_scan_run_reasons.append('argument')
+        elif hits > 0:
+          raise Exception('Potential infection found via maldet', p)
 
   makedirs(unscanned_downloads_dir, user = desired_username)
 
@@ -3604,44 +4058,58 @@ def update_av_if_online_then_do_scans():
       root = fixpath(os.path.join(unscanned_downloads_dir, i))
       for j in os.listdir(root):
         shutil.move(os.path.join(root, j), os.path.join(troot, j))
-    while True:
+    # NB: only processes that had something open under tdir (or that started
+    #     since) are re-read between retries. tdir is new so nothing else can
+    #     reach it by path, but a full sweep still confirms before scanning.
+    processes = ProcessTable()
+    while open_links := processes.links_under(tdir):
       links_of_interest_by_exe = {}
-      for i in filter(str.isdigit, os.listdir('/proc')):
-        links = {}
-        for i in ('exe', 'cwd', 'root'):
-          try:
-            links[i] = os.path.abspath(os.readlink(f'/proc/{i}/exe'))
-          except FileNotFoundError:
-            links[i] = '[None]'
-        try:
-          fds = os.listdir(f'/proc/{i}/fd')
-        except FileNotFoundError:
-          fds = []
-        for j in fds:
-          fd_path = f'fd/{j}'
-          try:
-            links[fd_path] = os.path.abspath(os.readlink(f'/proc/{i}/' + fd_path))
-          except FileNotFoundError:
-            links[fd_path] = '[None]'
-        links_of_interest = {}
-        for path, dest in links.items():
-          if tdir in dest:
-            links_of_interest[path] = dest
-        if len(links_of_interest) > 0:
-          links_of_interest_by_exe \
-            .setdefault(links['exe'], {}) \
-            .update(links_of_interest)
-      if len(links_of_interest_by_exe) < 1:
-        break
+      for pid, links in open_links.items():
+        links_of_interest_by_exe \
+          .setdefault(processes.processes[pid]['links']['exe'], {}) \
+          .update({f'{pid}/{k}': v for k, v in links.items()})
       alert(
         'Cannot safely scan downloads as some of the downloads are still open.',
         'Wait for the programs to close the files on their own or stop the',
         'affected programs:',
         pprint.pformat(links_of_interest_by_exe))
+      processes.refresh(pids = open_links)
+      if not processes.links_under(tdir):
+        processes.refresh()
 
     print('Scanning downloads...')
-    subprocess.check_call([maldet, '-a', tdir])
-    maldet_scan_run_reasons.append('downloads')
+    version = get_scan_signature_version(maldet)
+    clean = load_scan_ledger(version)
+    to_scan = {}
+    already_scanned = 0
+    for root, dirs, files in os.walk(tdir):
+      for i in files:
+        ipath = os.path.join(root, i)
+        if os.path.islink(ipath) or not os.path.isfile(ipath):
+          to_scan[ipath] = None
+          continue
+        with open(ipath, 'rb') as f:
+          digest = hashlib.file_digest(f, 'sha256').hexdigest()
+        if digest in clean:
+          already_scanned += 1
+        else:
+          to_scan[ipath] = digest
+    print('Skipping', already_scanned,
+          'file(s) already scanned with the current signatures')
+    if to_scan:
+      if any(('\n' in i for i in to_scan)):
+        hits = run_maldet_scan([maldet, '-a', tdir], check = True)
+      else:
+        fd, file_list = tempfile.mkstemp(prefix = 'lincfg_scan_')
+        try:
+          with open(fd, 'w') as f:
+            f.write('\n'.join(to_scan) + '\n')
+          hits = run_maldet_scan([maldet, '-f', file_list], check = True)
+        finally:
+          os.remove(file_list)
+      maldet_scan_run_reasons.append('downloads')
+      if hits == 0 and version:
+        record_clean_scans(version, clean, filter(None, to_scan.values()))
     print('Scan complete. Moving scanned files.')
     makedirs(scanned_downloads_dir, user = desired_username)
     merge_move(tdir, scanned_downloads_dir)
@@ -3653,18 +4121,20 @@ def update_av_if_online_then_do_scans():
 
 rat_message = 'Possible rootkit infection. See https://www.group-ib.com/blog/krasue-rat'
 @tasks.append
+@tagged('security')
+# NB: checks the /proc listing (a single readdir) rather than stat'ing
+#     /proc/758 since the rootkit hides its pid from readdir only
 def ensure_no_evidence_of_rat():
-  running_pids = [int(i) for i in filter(str.isdigit, os.listdir('/proc'))]
-  if 758 not in running_pids:
+  if '758' not in os.listdir('/proc'):
     try:
       os.kill(758, 64)
     except OSError as err:
       if abs(err.errno) == 0xBD:
-        raise Exception(message)
+        raise Exception(rat_message)
   for pfx in ('auwd', 'vmware_helper'):
     tdir = tempfile.mkdtemp(prefix=pfx)
     if os.path.basename(tdir) not in os.listdir(os.path.dirname(tdir)):
-      raise Exception(message, tdir)
+      raise Exception(rat_message, tdir)
     os.rmdir(tdir)
 
 SYSTEM_SITE_PACKAGES = site.getsitepackages()[0]
@@ -4090,7 +4560,190 @@ def diffcp_copy(name, destination, **kwargs):
       proc.check_returncode()
   return proc.returncode
 
+# Projects are synced with diffcp's semantics: sources are copied recursively,
+# entries matching symlink_patterns are linked back to their source instead
+# and exclude_patterns are skipped. Missing destinations are created directly,
+# while content changes to existing files need an interactive run, which hands
+# the project over to diffcp itself. Like diffcp --ternary-return-code, 0 means
+# something was copied, 1 that the project differs and 2 that it is already
+# identical.
+#
+# NB: the plan is made as root but carried out by project_sync_child_code
+#     running as the project's user (like diffcp under runuser), so a symlink
+#     or a swapped path in the user's tree can't be used to read or write
+#     anything the user couldn't already. Other symlinks in the sources are
+#     skipped and files are opened with O_NOFOLLOW.
+project_sync_jobs = 8
+
+project_sync_child_code = '''
+import sys, os, json, stat, fcntl, errno, concurrent.futures
+plan = json.load(sys.stdin)
+def copy(src, dst):
+  fsrc = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+  try:
+    st = os.fstat(fsrc)
+    if not stat.S_ISREG(st.st_mode):
+      raise OSError(errno.EINVAL, 'Not a regular file', src)
+    fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                   0o600)
+    try:
+      try:
+        fcntl.ioctl(fdst, plan['ficlone'], fsrc)
+      except OSError:
+        try:
+          if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, 'copy_file_range is unavailable')
+          while os.copy_file_range(fsrc, fdst, 4194304):
+            pass
+        except OSError:
+          os.lseek(fsrc, 0, os.SEEK_SET)
+          os.lseek(fdst, 0, os.SEEK_SET)
+          os.ftruncate(fdst, 0)
+          while buf := os.read(fsrc, 4194304):
+            os.write(fdst, buf)
+      os.fchmod(fdst, stat.S_IMODE(st.st_mode))
+      os.utime(fdst, ns = (st.st_atime_ns, st.st_mtime_ns))
+    finally:
+      os.close(fdst)
+  finally:
+    os.close(fsrc)
+for d in plan['dirs']:
+  os.makedirs(d, exist_ok = True)
+for src, dst in plan['symlinks']:
+  os.symlink(src, dst)
+with concurrent.futures.ThreadPoolExecutor(plan['jobs']) as ex:
+  for future in [ex.submit(copy, src, dst) for src, dst in plan['copies']]:
+    future.result()
+for path, mode in plan['chmods']:
+  os.chmod(path, mode)
+'''
+
+def get_indexed_stat(index, path, follow = True):
+  if (key := (path, follow)) not in index:
+    try:
+      index[key] = os.stat(path, follow_symlinks = follow)
+    except FileNotFoundError:
+      index[key] = None
+  return index[key]
+
+def plan_project_entry(plan, index, project, src, dst, rel):
+  if any((fnmatch.fnmatch(rel, i) for i in project.get('exclude_patterns', ()))):
+    return
+  if any((fnmatch.fnmatch(rel, i) for i in project.get('symlink_patterns', ()))):
+    if (dst_st := get_indexed_stat(index, dst, follow = False)) is None:
+      plan['symlinks'].append((src, dst))
+    elif not stat.S_ISLNK(dst_st.st_mode) or os.readlink(dst) != src:
+      plan['conflicts'].append(dst)
+    return
+  if (src_st := get_indexed_stat(index, src, follow = False)) is None:
+    plan['conflicts'].append(src)
+    return
+  if stat.S_ISLNK(src_st.st_mode):
+    return
+  dst_st = get_indexed_stat(index, dst, follow = False)
+  if stat.S_ISDIR(src_st.st_mode):
+    if dst_st is None:
+      plan['dirs'].append(dst)
+    elif not stat.S_ISDIR(dst_st.st_mode):
+      plan['conflicts'].append(dst)
+      return
+    for i in sorted(os.listdir(src)):
+      plan_project_entry(plan, index, project, os.path.join(src, i),
+                         os.path.join(dst, i), os.path.join(rel, i))
+    return
+  if not stat.S_ISREG(src_st.st_mode):
+    plan['conflicts'].append(src)
+    return
+  plan['files'].append(dst)
+  if dst_st is None:
+    plan['copies'].append((src, dst))
+  elif not (stat.S_ISREG(dst_st.st_mode) and
+            src_st.st_size == dst_st.st_size and
+            (src_st.st_mtime_ns == dst_st.st_mtime_ns or
+             filecmp.cmp(src, dst, shallow = False))):
+    plan['conflicts'].append(dst)
+
+def get_project_sync_plan(project, index):
+  plan = {'dirs': [], 'symlinks': [], 'copies': [], 'files': [], 'conflicts': []}
+  cwd = fixpath(project['cwd']) if project.get('cwd') else ''
+  destination = fixpath(project['destination'])
+  sources = [os.path.join(cwd, i) for i in get_project_sources(project)]
+  if len(sources) == 1:
+    dst_st = get_indexed_stat(index, destination)
+    src_st = get_indexed_stat(index, sources[0])
+    if dst_st and stat.S_ISDIR(dst_st.st_mode) and not \
+       (src_st and stat.S_ISDIR(src_st.st_mode)):
+      destination = os.path.join(destination, os.path.basename(sources[0]))
+    destinations = [destination]
+  else:
+    destinations = [os.path.join(destination, os.path.basename(i))
+                    for i in sources]
+  try:
+    for src, dst in zip(sources, destinations):
+      plan_project_entry(plan, index, project, src, dst, os.path.basename(src))
+  except OSError as e:
+    plan['conflicts'].append(e.filename)
+  return plan
+
+def apply_project_sync_plan(project, plan, index):
+  destination = fixpath(project['destination'])
+  if len(get_project_sources(project)) > 1:
+    dirs = [destination]
+  else:
+    dirs = [os.path.dirname(destination)]
+  if (mode := project.get('mode')) is not None:
+    chmods = [(destination, mode)]
+  elif (mode := project.get('recursive_mode')) is not None:
+    copied = set((dst for src, dst in plan['copies']))
+    chmods = [(dst, mode) for dst in plan['files'] if dst in copied or
+              stat.S_IMODE(get_indexed_stat(index, dst, False).st_mode) != mode]
+  else:
+    chmods = []
+  kwargs = {}
+  if (user := project.get('user')) and os.getuid() == 0:
+    pw = pwd.getpwnam(user)
+    kwargs = {'user': pw.pw_uid, 'group': pw.pw_gid, 'extra_groups': [],
+              'cwd': '/'}
+  subprocess.run((sys.executable, '-I', '-c', project_sync_child_code),
+                 input = json.dumps({
+                   'dirs': dirs + plan['dirs'],
+                   'symlinks': plan['symlinks'],
+                   'copies': plan['copies'],
+                   'chmods': chmods,
+                   'jobs': project_sync_jobs,
+                   'ficlone': FICLONE,
+                 }).encode(), check = True, **kwargs)
+
+def sync_projects(projects):
+  import concurrent.futures
+  index = {}
+  rcs = {}
+  pending = []
+  with concurrent.futures.ThreadPoolExecutor(project_sync_jobs) as ex:
+    plans = dict(zip(projects, ex.map(
+      lambda i: get_project_sync_plan(i, index), projects.values()
+    )))
+    for name, project in projects.items():
+      plan = plans[name]
+      if plan['conflicts']:
+        if flags('interact') and which('diffcp'):
+          kwargs = project.copy()
+          rcs[name] = diffcp_copy(name, kwargs.pop('destination'), **kwargs)
+        else:
+          reasons_interactive_setup_needed.append(f'diffcp: {name}')
+          rcs[name] = 1
+        continue
+      if not (plan['dirs'] or plan['symlinks'] or plan['copies']):
+        rcs[name] = 2
+        continue
+      pending.append(ex.submit(apply_project_sync_plan, project, plan, index))
+      rcs[name] = 0
+    for future in pending:
+      future.result()
+  return rcs
+
 @tasks.append
+@tagged('files')
 def cache_projects_via_diffcp():
   if not (diffcp := which('diffcp')):
     return
@@ -4109,10 +4762,7 @@ def cache_projects_via_diffcp():
       projects |= personal_postmarketos_locally_cached_projects
   if is_recovery():
     projects = {'auto_tpm_encrypt': projects['auto_tpm_encrypt']}
-  for project_name, project in projects.items():
-    kwargs = project.copy()
-    destination = kwargs.pop('destination')
-    diffcp_copy(project_name, destination, **kwargs)
+  sync_projects(projects)
 
 drm_root = '/sys/class/drm'
 radeon_rx_7900m_id = '1002:744c'
@@ -4121,6 +4771,7 @@ secure_boot_key_path = '/etc/secureboot/db.key'
 secure_boot_cert_path = '/etc/secureboot/db.crt'
 
 @tasks.append
+@tagged('files')
 def generate_auto_tpm_encrypt_config():
   if not which('auto_tpm_encrypt'):
     return
@@ -4166,6 +4817,7 @@ bottles_bottles_path = f'~{desired_username}/.var/app/com.usebottles.bottles/dat
 bottles_to_map_pool = ('Quaternary',)
 
 @tasks.append
+@tagged('files')
 def map_drive_to_each_bottle():
   for bottle_name in bottles_to_map_pool:
     devdir = fixpath(
@@ -4182,6 +4834,7 @@ def map_drive_to_each_bottle():
       os.symlink(bottles_pool_path, drive_path)
 
 @tasks.append
+@tagged('files')
 def ensure_pool_paths_exist():
   if is_recovery() or is_termux():
     return
@@ -4201,6 +4854,7 @@ potentially_missing_flatpak_dirs = [
 ]
 
 @tasks.append
+@tagged('files')
 def fix_potentially_missing_flatpak_dirs():
   if not which('flatpak'):
     return
@@ -4213,6 +4867,7 @@ flatpak_service_path_template = '/usr/lib/systemd/user/{}.service'
 flatpak_services_potentially_in_alt_lib_path = ('flatpak-portal', 'flatpak-session-helper')
 
 @tasks.append
+@tagged('services')
 def fix_flatpak_services_to_use_alt_lib_path_if_nessicary():
   reload_due = False
   for i in flatpak_services_potentially_in_alt_lib_path:
@@ -4623,19 +5278,161 @@ def get_desired_flatpaks():
     desired_flatpaks.update(arch_linux_desired_flatpaks)
   return desired_flatpaks
 
-@tasks.append
+flatpak_system_dir = '/var/lib/flatpak'
+flatpak_user_dir = '~/.local/share/flatpak'
+flatpak_flag_perms = ('shared', 'sockets', 'devices', 'features', 'persistent')
+flatpak_bus_policy_sections = {
+  'Session Bus Policy': 'session_bus_policy',
+  'System Bus Policy': 'system_bus_policy',
+}
+
+def parse_flatpak_keyfile(contents):
+  keyfile = {}
+  section = None
+  for line in contents.splitlines():
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    if line.startswith('[') and line.endswith(']'):
+      section = keyfile.setdefault(line[1:-1], {})
+    elif section is not None:
+      k, _, v = line.partition('=')
+      section[k.strip()] = v.strip()
+  return keyfile
+
+def split_flatpak_filesystem(entry):
+  path, _, mode = entry.rpartition(':')
+  if path and mode in ('ro', 'rw', 'create'):
+    return path, mode
+  return entry, 'rw'
+
+# Applies a metadata or override keyfile on top of context the same way flatpak
+# layers them. Negated entries are kept (as False/None) so later layers and
+# rewritten override files can still see them.
+def merge_flatpak_context(context, keyfile):
+  for k, v in keyfile.get('Context', {}).items():
+    items = filter(None, v.split(';'))
+    if k in flatpak_flag_perms:
+      for i in items:
+        context.setdefault(k, {})[i.lstrip('!')] = not i.startswith('!')
+    elif k == 'filesystems':
+      for i in items:
+        if i.startswith('!'):
+          path = split_flatpak_filesystem(i[1:].removesuffix(':reset'))[0]
+          context.setdefault(k, {})[path] = None
+        else:
+          path, mode = split_flatpak_filesystem(i)
+          context.setdefault(k, {})[path] = mode
+    elif k != 'unset-environment':
+      raise Exception('Unknown entry', 'Context', k)
+  for section, k in flatpak_bus_policy_sections.items():
+    for name, policy in keyfile.get(section, {}).items():
+      context.setdefault(k, {})[name] = policy
+  return context
+
+def get_flatpak_effective_permissions(context):
+  perms = {}
+  for k, v in context.items():
+    if k == 'filesystems':
+      perms[k] = {p if m == 'rw' else p+':'+m for p, m in v.items() if m}
+    elif k in flatpak_bus_policy_sections.values():
+      perms[k] = {n: p for n, p in v.items() if p != 'none'}
+    else:
+      perms[k] = {i for i, allowed in v.items() if allowed}
+  return {k: v for k, v in perms.items() if v}
+
+# Runtimes are listed alongside apps but have no "current" link, a runtime
+# listed by its ID alone has a single arch/branch deployed
+def find_flatpak_metadata(flatpak):
+  if '/' in flatpak:
+    app_id, arch, branch = flatpak.split('/', 2)
+    deploys = [os.path.join(kind, glob.escape(app_id), glob.escape(arch),
+                            glob.escape(branch), 'active', 'metadata')
+               for kind in ('app', 'runtime')]
+  else:
+    deploys = [
+      os.path.join('app', glob.escape(flatpak), 'current', 'active', 'metadata'),
+      os.path.join('runtime', glob.escape(flatpak), '*', '*', 'active', 'metadata'),
+    ]
+  for installation in (flatpak_system_dir, flatpak_user_dir):
+    for deploy in deploys:
+      for path in sorted(glob.glob(os.path.join(glob.escape(fixpath(installation)),
+                                                deploy))):
+        if os.path.isfile(path):
+          return path
+  return None
+
+# Equivalent to flatpak info --show-permissions: the app metadata followed by
+# the global and per-app overrides of the system and then the user installation
+def get_flatpak_permissions(metadata_path, flatpak, skip = ()):
+  app_id = flatpak.split('/')[0]
+  paths = [metadata_path]
+  for installation in (flatpak_system_dir, flatpak_user_dir):
+    overrides_dir = os.path.join(fixpath(installation), 'overrides')
+    paths += [os.path.join(overrides_dir, 'global'),
+              os.path.join(overrides_dir, app_id)]
+  context = {}
+  for path in paths:
+    if path in skip:
+      continue
+    _, contents = read_config(path, default_contents = '')
+    merge_flatpak_context(context, parse_flatpak_keyfile(contents))
+  return get_flatpak_effective_permissions(context)
+
+# Produces the same override file flatpak override would write when given the
+# nofoo/foo arguments described by remove_map and add_map
+def format_flatpak_override(keyfile, remove_map, add_map):
+  context = merge_flatpak_context({}, keyfile)
+  for changes, allowed in ((remove_map, False), (add_map, True)):
+    for k, v in changes.items():
+      for i in v:
+        if k == 'filesystems':
+          path, mode = split_flatpak_filesystem(i)
+          context.setdefault(k, {})[path] = mode if allowed else None
+        elif k in flatpak_bus_policy_sections.values():
+          context.setdefault(k, {})[i] = 'none'
+        else:
+          context.setdefault(k, {})[i] = allowed
+  section = keyfile.setdefault('Context', {})
+  for k, v in context.items():
+    if k == 'filesystems':
+      section[k] = ''.join(
+        ('!'+p if m is None else p if m == 'rw' else p+':'+m) + ';'
+        for p, m in sorted(v.items()))
+    elif k in flatpak_flag_perms:
+      section[k] = ''.join(
+        ('' if allowed else '!') + i + ';' for i, allowed in sorted(v.items()))
+  for name, k in flatpak_bus_policy_sections.items():
+    if k in context:
+      keyfile[name] = dict(sorted(context[k].items()))
+  return ''.join(
+    f'[{name}]\n' + ''.join(f'{k}={v}\n' for k, v in section.items()) + '\n'
+    for name, section in keyfile.items() if section).rstrip('\n') + '\n'
+
+# NB: the missing repo dirs are created here too so that this doesn't wait
+#     for fix_potentially_missing_flatpak_dirs, the service paths only matter
+#     once flatpaks are run
+@network_task('install_or_update_packages')
+@tagged('packages')
+def update_flatpaks():
+  if in_container() or is_termux() or flags('offline'):
+    return
+  fix_potentially_missing_flatpak_dirs()
+  for flatpak in (get_desired_flatpaks() - get_installed_flatpaks()):
+    subprocess.run(['flatpak', 'install', '--noninteractive', flatpak])
+  subprocess.check_call(['flatpak', 'update', '--assumeyes'])
+  invalidate('flatpaks')
+
+@prereq_task('fix_potentially_missing_flatpak_dirs',
+              'fix_flatpak_services_to_use_alt_lib_path_if_nessicary',
+              'update_flatpaks')
+@tagged('packages')
 def update_flatpaks_and_fix_permissions():
   if in_container() or is_termux():
     return
 
   installed_flatpaks = get_installed_flatpaks()
 
-  if not flags('offline'):
-    for flatpak in (get_desired_flatpaks() - installed_flatpaks):
-      subprocess.run(['flatpak', 'install', '--noninteractive', flatpak])
-    subprocess.check_call(['flatpak', 'update', '--assumeyes'])
-    installed_flatpaks = get_installed_flatpaks()
-
   # NB: revokes overly permissive default permissions
   #     won't touch user assigned overrides
   # removes all potentially dangerous permissions unless they're in flatpak_exceptions
@@ -4656,26 +5453,27 @@ def update_flatpaks_and_fix_permissions():
     ('System',  'talk', None): 'system-no-talk-name',
     ('System',  'own',  None): 'system-no-talk-name',
   }
-  flatpak_runtimes = set(subprocess.check_output(
-    ['flatpak', 'list', '--app', '--columns=runtime']).decode().splitlines())
-
-  for flatpak in sorted(installed_flatpaks - flatpak_runtimes):
-    if flags('fpoverrides') and '/' not in flatpak:
-      subprocess.run(['flatpak', 'override', '--reset', flatpak])
-
-    perms = subprocess.check_output(
-            ['flatpak', 'info', '--show-permissions', flatpak]).decode()
+  unremovable = []
+  pending_overrides = {}
+  for flatpak in sorted(installed_flatpaks - get_flatpak_runtimes()):
+    reset = flags('fpoverrides') and '/' not in flatpak
+    metadata_path = find_flatpak_metadata(flatpak)
+    if metadata_path:
+      override_path = os.path.join(fixpath(flatpak_system_dir),
+                                   'overrides', flatpak)
+      perms = get_flatpak_permissions(metadata_path, flatpak,
+                                      skip = (override_path,) if reset else ())
+    else:
+      if reset:
+        subprocess.run(['flatpak', 'override', '--reset', flatpak])
+      perms = subprocess.check_output(
+              ['flatpak', 'info', '--show-permissions', flatpak]).decode()
+      perms = get_flatpak_effective_permissions(
+        merge_flatpak_context({}, parse_flatpak_keyfile(perms)))
     remove_args, add_args = [], []
-    remove_map = {}
-    for line in perms.splitlines():
-      if not line:
-        continue
-      if line.startswith('[') and line.endswith(']'):
-        current_section = line[1:-1]
-        continue
-      idx = line.index('=')
-      k,v = line[:idx], set(filter(None, line[idx+1:].split(';')))
-      if current_section == 'Context' and k in noperm2arg:
+    remove_map, add_map = {}, {}
+    for k, v in sorted(perms.items()):
+      if k in noperm2arg:
         to_remove = (v
                       - set(map(fixpath,
                                 flatpak_exceptions
@@ -4686,40 +5484,54 @@ def update_flatpaks_and_fix_permissions():
                     noperm2arg[k] == 'nofilesystem'
                     else i for i in to_remove}
         if len(to_remove) > 0 and noperm2arg[k] is None:
-          print('Unable to remove ' + line + ' for ' + flatpak + '\n' +
+          print('Unable to remove ' + k + '=' + ';'.join(sorted(v)) +
+                ' for ' + flatpak + '\n' +
                 'Either add an exception for the path or uninstall the flatpak.\n' +
                 'See https://github.com/flatpak/flatpak/issues/5042')
-          sys.exit(-1)
-        remove_args += ['--'+noperm2arg[k]+'='+i for i in to_remove]
+          unremovable.append(flatpak)
+          continue
+        remove_args += ['--'+noperm2arg[k]+'='+i for i in sorted(to_remove)]
         remove_map.setdefault(k, set()).update(to_remove)
-      elif current_section.endswith('Bus Policy'):
-        v = tuple(v)[0] if len(v) == 1 else v
-        sk = current_section[:-11].lower()+'_bus_policy'
-        want = (flatpak_exceptions
-                .get(flatpak, {})
-                .get(sk, {})
-                .get(k))
-        if v != want:
-          remove_args += ['--' + bus_perm2arg[current_section[:-11], v, want] + '=' + k]
-          remove_map.setdefault(sk, set()).add(k)
-      elif current_section == 'Environment':
-        pass
-      elif current_section == 'Context' and k in {'unset-environment'}:
-        pass
+      elif k.endswith('_bus_policy'):
+        for name, policy in sorted(v.items()):
+          want = (flatpak_exceptions
+                  .get(flatpak, {})
+                  .get(k, {})
+                  .get(name))
+          if policy != want:
+            remove_args += ['--' + bus_perm2arg[k[:-11].capitalize(), policy, want] + '=' + name]
+            remove_map.setdefault(k, set()).add(name)
       else:
-        raise Exception('Unknown entry', current_section, k)
+        raise Exception('Unknown entry', flatpak, k)
     for k, v in flatpak_exceptions.get(flatpak, {}).items():
         v = set(v.keys())if type(v) is dict else v
         to_add = v - remove_map.get(k, set())
         if len(to_add) > 0 and k in perm2arg:
-          add_args += [
-            '--'+perm2arg[k]+'='+(fixpath(i) if k == 'filesystems' else i)
-            for i in to_add
-          ]
-    if len(remove_args) > 0 and '/' not in flatpak:
-      cmd = ['flatpak', 'override'] + remove_args + add_args + [flatpak]
-      print('Running:', shlex.join(cmd))
-      subprocess.check_call(cmd)
+          to_add = {fixpath(i) if k == 'filesystems' else i for i in to_add}
+          add_args += ['--'+perm2arg[k]+'='+i for i in sorted(to_add)]
+          add_map.setdefault(k, set()).update(to_add)
+    if '/' in flatpak:
+      continue
+    if not metadata_path:
+      if len(remove_args) > 0:
+        cmd = ['flatpak', 'override'] + remove_args + add_args + [flatpak]
+        print('Running:', shlex.join(cmd))
+        subprocess.check_call(cmd)
+    elif len(remove_args) > 0:
+      print('Overriding:', flatpak, shlex.join(remove_args + add_args))
+      _, override = read_config(override_path, default_contents = '')
+      pending_overrides[override_path] = format_flatpak_override(
+        parse_flatpak_keyfile('' if reset else override), remove_map, add_map)
+    elif reset and os.path.exists(override_path):
+      pending_overrides[override_path] = None
+
+  for override_path, contents in pending_overrides.items():
+    if contents is None:
+      os.remove(override_path)
+    else:
+      write_config(override_path, contents)
+  if unremovable:
+    sys.exit(-1)
 
 CHROMIUM_FLAGS = """
 --enable-features=UseOzonePlatform
@@ -4732,7 +5544,8 @@ CHROMIUM_FLAG_PATHS = [
   f'~{desired_username}/.var/app/com.microsoft.Edge/config/edge-flags.conf',
 ]
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def set_chromium_wayland_flags():
   for path in map(fixpath, CHROMIUM_FLAG_PATHS):
     try:
@@ -4773,7 +5586,8 @@ Keywords=cloud;game;gaming;nvidia;stream;steaming;steam;epic;ubisoft;
 
 }
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def create_pwa_shortcuts_for_installed_pwas():
   for shortcut_path, desired_shortcut in pwa_shortcuts.items():
     original_icon_path = re.search(r'Icon=(.+)', desired_shortcut).group(1)
@@ -4787,7 +5601,8 @@ def create_pwa_shortcuts_for_installed_pwas():
 
 firefox_shortcut_path = '/usr/share/applications/firefox.desktop'
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def fix_firefox_file_picker():
   firefox_path = which('firefox')
   if not firefox_path:
@@ -4840,16 +5655,18 @@ exec wasmer run \
   sharrattj/bash "$@"
 '''.lstrip()
 
-@tasks.append
+@prereq_task()
+@tagged('packages')
 def ensure_wasmer_script_updated():
   if not which('wasmer'):
     return
   p, wasmer_script = read_config(wasmer_script_path, default_contents = '')
   if wasmer_script != desired_wasmer_script:
-    write_config(p, desired_wasmer_script, user = desired_username)
-    os.chmod(p, OWNER_CAN_RWX)
+    write_config(p, desired_wasmer_script, user = desired_username,
+                 perms = OWNER_CAN_RWX)
 
 @tasks.append
+@tagged('files')
 def make_virtuator_symlink():
   project_name = 'virtuator_lib'
   project = common_personal_locally_cached_projects[project_name]
@@ -5122,27 +5939,41 @@ all_enabled_services = enabled_services | enabled_user_services
 system_service_root = '/etc/systemd/system'
 user_service_root = f'~{desired_username}/.config/systemd/user'
 
-@tasks.append
+# All unit files are staged first, then each scope gets a single daemon-reload
+# and a single enable call for the units it gained
+@prereq_task()
+@tagged('services')
 def generate_services():
   if not (systemctl := which('systemctl')):
     return
+  scope_cmds = {
+    'system': [systemctl],
+    'user': ['runuser', f'-u{desired_username}', '--', systemctl, '--user'],
+  }
+  changed_units = {}
+  new_enabled_units = {}
   for service_name, get_desired_service in all_services.items():
     if not (desired_service := get_desired_service()):
       continue
     if service_name in all_system_services:
-      cmd = [systemctl]
+      scope = 'system'
       root = system_service_root
     else:
+      scope = 'user'
       root = user_service_root
-      cmd = ['runuser', f'-u{desired_username}', '--', systemctl, '--user']
     service_path = os.path.join(root, service_name + '.service')
     p, service = read_config(service_path, default_contents = '')
     if service != desired_service:
       write_config(p, desired_service)
-      if not in_container():
-        subprocess.check_call(cmd + ['daemon-reexec'])
+      changed_units.setdefault(scope, []).append(os.path.basename(p))
     if not service and service_name in all_enabled_services:
-      subprocess.check_call(cmd + ['enable', os.path.basename(p)])
+      new_enabled_units.setdefault(scope, []).append(os.path.basename(p))
+  for scope, units in changed_units.items():
+    print(f'Updated {scope} units:', ' '.join(units))
+    if not in_container():
+      subprocess.check_call(scope_cmds[scope] + ['daemon-reload'])
+  for scope, units in new_enabled_units.items():
+    subprocess.check_call(scope_cmds[scope] + ['enable'] + units)
 
 service_paths_to_remove = (
   '/etc/systemd/system/swap.target.wants/zram-swap.service',
@@ -5153,7 +5984,8 @@ service_paths_to_remove = (
   '/usr/lib/systemd/system/timers.target.wants/archlinux-keyring-wkd-sync.timer',
 )
 
-@tasks.append
+@prereq_task()
+@tagged('services')
 def disable_unused_services():
   for path in service_paths_to_remove:
     if os.path.islink(path):
@@ -5163,6 +5995,7 @@ pacman_gnupg = '/etc/pacman.d/gnupg'
 A_WEEK = 7*24*60*60
 
 @tasks.append
+@tagged('services', 'network', 'maintenance')
 def run_periodic_tasks():
   if systemd_tmpfiles := which('systemd-tmpfiles'):
     subprocess.check_call((systemd_tmpfiles, '--clean'))
@@ -5184,7 +6017,8 @@ def run_periodic_tasks():
 ROOT_SSH_CONFIG_TEMPLATE = '''
 '''.lstrip()
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def generate_root_ssh_config():
   if not is_parent_pc():
     return
@@ -5201,7 +6035,8 @@ EMERGENCY_SIGNED_RUN_CONF_TEMPLATE = '''
 PASSWORD='_PASS'
 '''.lstrip()
 
-@tasks.append
+@prereq_task()
+@tagged('files')
 def update_emergency_signed_run_conf():
   if not which('emergency-signed-run'):
     return
@@ -5234,7 +6069,8 @@ def update_emergency_signed_run_conf():
 
 launcher_icon_dst_path = f'~{desired_username}/.local/share/icons/hicolor/512x512/apps/invader.png'
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def ensure_launcher_icon_is_up_to_date():
   try:
     src_mtime = os.path.getmtime(fixpath(launcher_icon_src_path))
@@ -5291,7 +6127,9 @@ local_cloud_roots = {
   f'~{desired_username}/OneDrive',
 }
 
+# NB: stays a barrier since alert() prompts on stdin
 @tasks.append
+@tagged('files')
 def check_symlinks():
   pre = [i + os.path.sep for i in map(fixpath, local_cloud_roots)]
   for link_pattern in symlinks_to_check:
@@ -5306,6 +6144,7 @@ def check_symlinks():
         alert(f'Not a symlink: {link}')
 
 @tasks.append
+@tagged('kde')
 def update_app_cache():
   if not (kbuildsycoca := which('kbuildsycoca6')):
     return
@@ -5317,6 +6156,7 @@ def update_app_cache():
 only_enable_baloo_temporarily = True
 
 @tasks.append
+@tagged('files')
 def update_file_index():
   if not (balooctl := which('balooctl6')):
     return
@@ -5375,7 +6215,8 @@ def update_file_index():
 #                      preexec_fn=os.setpgrp,
 #                      env=envd)
 
-@lambda f: (tasks.insert(1, f), tasks.append(f))
+@lambda f: (startup_task(1)(f), tasks.append(f))
+@tagged('files')
 def trigger_storage_minder_cleanup_script():
   project = common_locally_cached_projects['storage_minder_cleanup_script']
   script_path = fixpath(project['destination'])
@@ -5390,28 +6231,88 @@ def trigger_storage_minder_cleanup_script():
     return
   subprocess.check_call((get_shell(), script_path))
 
+log_cursors_name = 'log_cursors.json'
+log_cursor_head_length = 4096
+
+def load_log_cursors():
+  return load_lincfg_json(log_cursors_name, {})
+
+# Returns the records parse() found in the log, only parsing the complete lines
+# appended since the last call. A trailing line without a newline is parsed for
+# this call only and again once it is complete. A different inode, a shrunken
+# file or a changed head (truncated and rewritten in place) starts over from the
+# beginning. Only the last keep records are kept between runs, callers reading
+# logs that are rewritten on every run (rkhunter, lynis) can keep them all.
+def read_log_records(path, parse, keep = None):
+  path = fixpath(path)
+  cursors = load_log_cursors()
+  cursor = cursors.get(path, {})
+  with open(path, 'rb') as f:
+    st = os.fstat(f.fileno())
+    offset = cursor.get('offset', 0)
+    head = hashlib.sha256(f.read(min(offset, log_cursor_head_length)))
+    if cursor.get('inode') != st.st_ino or offset > st.st_size or \
+       cursor.get('head') != head.hexdigest():
+      cursor = {'inode': st.st_ino, 'offset': 0, 'records': []}
+    f.seek(cursor['offset'])
+    data = f.read()
+    end = data.rfind(b'\n') + 1
+    cursor['records'] += parse(data[:end].decode(errors = 'replace'))
+    if keep is not None:
+      cursor['records'] = cursor['records'][-keep:]
+    partial = parse(data[end:].decode(errors = 'replace')) if data[end:] else []
+    cursor['offset'] += end
+    f.seek(0)
+    cursor['head'] = hashlib.sha256(
+      f.read(min(cursor['offset'], log_cursor_head_length))).hexdigest()
+  cursors[path] = cursor
+  save_lincfg_json(log_cursors_name, cursors)
+  return (cursor['records'] + partial)[-keep if keep else 0:]
+
+def parse_maldet_event_log(log):
+  return [{'kind': 'scan', 'hits': int(i)}
+          for i in re.findall(r'malware hits (\d+),', log)]
+
+def parse_rkhunter_log(log):
+  return [{'kind': kind, 'count': int(count)}
+          for kind, count in re.findall(r'(Suspect files|Possible rootkits): (\d+)', log)]
+
+lynis_finding_kinds = ('Error', 'Warning', 'Exception', 'Suggestion')
+
+def parse_lynis_log(log):
+  records = []
+  for line in log.splitlines():
+    for kind in lynis_finding_kinds:
+      records += [{'kind': kind, 'line': line}] * line.count(kind + ':')
+    if 'This release is more than' in line:
+      records.append({'kind': 'outdated', 'line': line})
+  return records
+
 def check_maldet_log():
-  p, maldet_log = read_config('/var/log/maldet/event_log')
-  if re.findall(r'malware hits (\d+),', maldet_log)[-1] != '0':
+  scans = read_log_records('/var/log/maldet/event_log', parse_maldet_event_log,
+                           keep = 1)
+  if not scans:
+    raise Exception('No maldet scan results found')
+  if scans[-1]['hits'] != 0:
     raise Exception('Potential infection found via maldet')
 
-@tasks.append
+@prereq_task('update_av_if_online_then_do_scans')
+@tagged('security')
 def check_av_scan_logs():
   if which('rkhunter'):
-    p, rkhunter_log = read_config('/var/log/rkhunter.log')
-    if any((int(i[1]) > 0 for i in re.findall(r'(Suspect files|Possible rootkits): (\d+)', rkhunter_log))):
-      raise Exception('Potential infection found via rkhunter')
+    findings = read_log_records('/var/log/rkhunter.log', parse_rkhunter_log)
+    if findings := [i for i in findings if i['count'] > 0]:
+      raise Exception('Potential infection found via rkhunter', findings)
 
   if which('lynis') and flags('scan'):
-    p, lynis_log = read_config('/var/log/lynis.log')
-    error_count = lynis_log.count('Error:')
-    warning_count = lynis_log.count('Warning:')
-    exception_count = lynis_log.count('Exception:')
-    suggestion_count = lynis_log.count('Suggestion:')
-    if 'This release is more than' in lynis_log:
-      suggestion_count -= 1
-    if any((i != 0 for i in (error_count, warning_count, exception_count, suggestion_count))):
-      raise Exception('Potential issue found via lynis')
+    findings = read_log_records('/var/log/lynis.log', parse_lynis_log)
+    counts = {kind: 0 for kind in lynis_finding_kinds}
+    for i in findings:
+      counts[i['kind']] = counts.get(i['kind'], 0) + 1
+    if counts.pop('outdated', 0):
+      counts['Suggestion'] -= 1
+    if any((i != 0 for i in counts.values())):
+      raise Exception('Potential issue found via lynis', counts)
 
   if maldet_scan_run_reasons:
     check_maldet_log()
@@ -5736,6 +6637,7 @@ known_issues_with_deadlines = {
 }
 
 @tasks.append
+@tagged('packages', 'security')
 def run_arch_audit():
   if not which('arch-audit') or flags('offline'):
     return
@@ -5765,9 +6667,13 @@ def extract_first_graphviz_string(txt):
     return ''
   return json.loads(m.group(0))
 
+@run_cached('packages')
 def get_package_metadata():
   meta = {}
-  if is_arch_linux():
+  if is_arch_linux() and (db := get_pacman_local_db()) is not None:
+    for name, p in db.items():
+      meta[name] = {'required_by': set(p['required_by'])}
+  elif is_arch_linux():
     last_key = None
     for line in filter(str.strip, subprocess.check_output(['pacman', '-Qi'])
                       .decode().splitlines()):
@@ -5808,7 +6714,8 @@ def make_sure_no_partitions_are_unsealed():
 
 kate_session_file_path = f'~{desired_username}/.local/share/kate/sessions/Default.katesession'
 
-@tasks.append
+@prereq_task()
+@tagged('kde')
 def backup_kate_session_for_debugging():
   p, current = read_config(kate_session_file_path, default_contents = '')
   if not current:
@@ -5833,9 +6740,10 @@ def run_sysemctl(cmd, user = None, capture_output = False):
     cmd = ['systemctl'] + cmd
   return subprocess.run(cmd, check = True, capture_output = capture_output)
 
+@run_cached('services')
 def get_running_services(user = None):
   if in_container():
-    return set()
+    return frozenset()
   proc = run_sysemctl(['show', '*.service'],
                       user = user,
                       capture_output = True)
@@ -5849,21 +6757,75 @@ def get_running_services(user = None):
       if unit.get('SubState') == 'running':
         running.add(unit['Id'][:-8])
       unit = {}
-  return running
+  return frozenset(running)
+
+# Snapshot of /proc taken in a single sweep. Holds each process' comm plus the
+# targets of its exe, cwd and root links and (with fds = True) of its open fds.
+# refresh() drops exited processes and reads new ones, but only re-reads the
+# existing processes listed in pids (all of them when pids is None).
+class ProcessTable(object):
+  links = ('exe', 'cwd', 'root')
+
+  def __init__(self, fds = True):
+    self.with_fds = fds
+    self.processes = {}
+    self.comm_index = {}
+    self.refresh()
+
+  @staticmethod
+  def read_link(base, name):
+    try:
+      dest = os.readlink(os.path.join(base, name))
+    except OSError:
+      return '[None]'
+    return os.path.abspath(dest) if dest.startswith('/') else dest
+
+  def read_process(self, pid):
+    base = os.path.join('/proc', str(pid))
+    _, comm = read_config(os.path.join(base, 'comm'), default_contents = '')
+    links = {name: self.read_link(base, name) for name in self.links}
+    if self.with_fds:
+      try:
+        with os.scandir(os.path.join(base, 'fd')) as it:
+          for entry in it:
+            links['fd/' + entry.name] = self.read_link(base, 'fd/' + entry.name)
+      except OSError:
+        pass
+    return {'comm': comm.strip(), 'links': links}
+
+  def refresh(self, pids = None):
+    try:
+      with os.scandir('/proc') as it:
+        running = {int(i.name) for i in it if i.name.isdigit()}
+    except FileNotFoundError:
+      running = set()
+    for pid in set(self.processes) - running:
+      del self.processes[pid]
+    for pid in running:
+      if pids is None or pid in pids or pid not in self.processes:
+        self.processes[pid] = self.read_process(pid)
+    self.comm_index = {}
+    for pid, info in self.processes.items():
+      self.comm_index.setdefault(info['comm'], set()).add(pid)
+
+  def pids_with_comm(self, comms):
+    return set().union(*(self.comm_index.get(i, ()) for i in comms))
+
+  def links_under(self, path):
+    path = os.path.abspath(path)
+    found = {}
+    for pid, info in self.processes.items():
+      for name, dest in info['links'].items():
+        if dest == path or dest.startswith(path + os.path.sep):
+          found.setdefault(pid, {})[name] = dest
+    return found
+
+@run_cached('procs')
+def get_process_table():
+  return ProcessTable(fds = False)
 
 def has_proc_comm(targets):
-  try:
-    pids = os.listdir('/proc')
-  except FileNotFoundError:
-    return False
-  for pid in pids:
-    if not pid.isdigit():
-      continue
-    _, comm = read_config(os.path.join('/proc', pid, 'comm'),
-                          default_contents = '')
-    if comm.strip() in targets:
-      return True
-  return False
+  return len(get_process_table().pids_with_comm(targets)) > 0
 
 restartable_system_services = {
   'Sessen',
@@ -5908,6 +6870,7 @@ restartable_user_services = {
 }
 
 @tasks.append
+@tagged('services')
 def live_soft_reboot():
   if not sys.stdin.isatty():
     return
@@ -5920,8 +6883,10 @@ def live_soft_reboot():
     needs_restart = restartable.intersection(running)
     if len(needs_restart) > 0:
       run_sysemctl(['restart'] + list(needs_restart), user = u)
+      invalidate('services', 'procs')
 
 @tasks.append
+@tagged('services')
 def restore_power_profile():
   if 'balanced-performance' not in get_platform_profiles():
     return
@@ -5930,7 +6895,95 @@ def restore_power_profile():
     with open(p, 'w') as f:
       f.write('balanced-performance')
 
+# Everything the given packages depend on, directly or not
+def get_package_dependency_closure(packages, meta):
+  requires = {}
+  for package, m in meta.items():
+    for r in m['required_by']:
+      requires.setdefault(r, set()).add(package)
+  closure = set(packages)
+  queue = list(closure)
+  for package in queue:
+    for dep in requires.get(package, ()):
+      if dep not in closure:
+        closure.add(dep)
+        queue.append(dep)
+  return closure
+
+# Iterative Tarjan, graph maps each node to its successors. Components come out
+# in reverse topological order.
+def get_strongly_connected_components(graph):
+  index = {}
+  low = {}
+  stack = []
+  on_stack = set()
+  components = []
+  for root in graph:
+    if root in index:
+      continue
+    index[root] = low[root] = len(index)
+    stack.append(root)
+    on_stack.add(root)
+    work = [(root, iter(graph[root]))]
+    while work:
+      node, successors = work[-1]
+      for succ in successors:
+        if succ not in index:
+          index[succ] = low[succ] = len(index)
+          stack.append(succ)
+          on_stack.add(succ)
+          work.append((succ, iter(graph[succ])))
+          break
+        elif succ in on_stack:
+          low[node] = min(low[node], index[succ])
+      else:
+        work.pop()
+        if work:
+          parent = work[-1][0]
+          low[parent] = min(low[parent], low[node])
+        if low[node] == index[node]:
+          component = []
+          while True:
+            on_stack.discard(n := stack.pop())
+            component.append(n)
+            if n == node:
+              break
+          components.append(component)
+  return components
+
+# Splits packages into batches that can each be removed by one transaction.
+# A package is only removed after every package requiring it and each
+# dependency cycle goes in a single batch, returned separately as well.
+def get_package_removal_batches(packages, meta):
+  graph = {p: (meta[p]['required_by'] if p in meta else set()) & packages
+           for p in packages}
+  components = get_strongly_connected_components(graph)
+  component_of = {p: i for i, c in enumerate(components) for p in c}
+  dependencies = [set() for _ in components]
+  pending = [0] * len(components)
+  for p, required_by in graph.items():
+    for r in required_by:
+      if (i := component_of[p]) != (j := component_of[r]) and \
+         i not in dependencies[j]:
+        dependencies[j].add(i)
+        pending[i] += 1
+  layer = [i for i in range(len(components)) if not pending[i]]
+  batches = []
+  while layer:
+    batches.append(sorted((p for i in layer for p in components[i])))
+    next_layer = []
+    for j in layer:
+      for i in dependencies[j]:
+        pending[i] -= 1
+        if not pending[i]:
+          next_layer.append(i)
+    layer = next_layer
+  cycles = [sorted(c) for c in components if len(c) > 1]
+  return batches, cycles
+
 @tasks.append
+@interactive_task
+@tagged('packages')
 def remove_undesired_packages():
   if not flags('undesired'):
     return
@@ -5939,59 +6992,45 @@ def remove_undesired_packages():
   desired_packages = set(get_desired_packages(include_aur = True))
   meta = get_package_metadata()
 
-  while True:
-    starting_length = len(desired_packages)
-    for package, m in meta.items():
-      if m['required_by'].intersection(desired_packages):
-        desired_packages.add(package)
-    if len(desired_packages) == starting_length:
-      break
-
-  undesired_packages = all_packages - desired_packages
-  undesired_packages_ordered_by_requirements = []
-  already_sorted_packages = set()
-  while len(undesired_packages_ordered_by_requirements) != len(undesired_packages):
-    starting_length = len(undesired_packages_ordered_by_requirements)
-    for package in undesired_packages:
-      m = meta.get(package)
-      required_by = m['required_by'] if m else set()
-      if package not in already_sorted_packages and \
-        not (required_by - already_sorted_packages):
-        undesired_packages_ordered_by_requirements.append(package)
-        already_sorted_packages.add(package)
-    if len(undesired_packages_ordered_by_requirements) == starting_length:
-      break
-
-  packages_with_circular_dependencies = undesired_packages - set(undesired_packages_ordered_by_requirements)
+  desired_packages = get_package_dependency_closure(desired_packages, meta)
+  batches, cycles = get_package_removal_batches(all_packages - desired_packages,
+                                                meta)
+  packages_to_remove = [p for batch in batches for p in batch]
 
   print('Removing undesired packages:')
-  print(f'{len(undesired_packages_ordered_by_requirements)} package(s) without circular dependencies will be removed')
-  if len(undesired_packages_ordered_by_requirements) > 0:
-    print(textwrap.fill(shlex.join(undesired_packages_ordered_by_requirements),
-                        initial_indent = '  ',
-                        subsequent_indent = '  '))
-  print(f'{len(packages_with_circular_dependencies)} package(s) with circular dependencies will be removed')
-  if len(packages_with_circular_dependencies) > 0:
-    print(textwrap.fill(shlex.join(packages_with_circular_dependencies),
+  print(f'{len(packages_to_remove)} package(s) will be removed in {len(batches)} transaction(s)')
+  for i, batch in enumerate(batches):
+    print(textwrap.fill(shlex.join(batch),
+                        initial_indent = f'  {i+1}: ',
+                        subsequent_indent = '     '))
+  print(f'{len(cycles)} circular dependency group(s) will be removed as a unit')
+  for cycle in cycles:
+    print(textwrap.fill(shlex.join(cycle),
                         initial_indent = '  ',
                         subsequent_indent = '  '))
-  packages_to_remove = undesired_packages_ordered_by_requirements + list(packages_with_circular_dependencies)
   if len(packages_to_remove) > 0:
     print('Type YES to proceed or press Ctrl + C to cancel.')
     print('Cancel if you would prefer to remove the packages manually.\n')
     if input('!!! ') == 'YES':
+      cmd = None
       if is_arch_linux():
-        subprocess.check_call(shlex.split('pacman -R') + packages_to_remove)
+        cmd = shlex.split('pacman -R')
       elif is_postmarketos():
-        subprocess.check_call(shlex.split('apk del') + packages_to_remove)
+        cmd = shlex.split('apk del')
       elif is_termux():
         raise NotImplementedError()
+      try:
+        for batch in batches if cmd else ():
+          subprocess.check_call(cmd + batch)
+      finally:
+        invalidate('packages')
     else:
       print('Skipped package removal')
   else:
     print('Nothing to remove!')
 
 @tasks.append
+@tagged('system')
 def display_done_message():
   # print('Done but manually need to pick: hostname, user and root pass, grub config, fstab, rclone')
   if not reasons_interactive_setup_needed:
@@ -6003,7 +7042,8 @@ def display_done_message():
 
 ESP_GUID = 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b'
 
-@lambda f: tasks.insert(0, f)
+@startup_task(0)
+@tagged('system', 'packages', 'network')
 def handle_init():
   if not (root_dev := os.environ.get('LINCFG_INIT_ROOT', '').strip()):
     return
@@ -6056,44 +7096,152 @@ def in_container():
 
 def alert(*msg, title = 'Alert', width = 80, interactive = True):
   msg = '\n'.join(map(str, msg))
-  print('\n')
-  print('--- [' + title + '] ' + ('-'*(width-(len(title)+7))))
-  print('\n' + msg + '\n')
-  print('-'*width)
-  if interactive:
-    print('Press enter to continue or Ctrl + C to abort')
-  print('-'*width)
-  print('')
-  i = input() if interactive else None
+  # NB: without a terminal (e.g. under --fleet) there is nobody to answer
+  interactive = interactive and sys.stdin and sys.stdin.isatty()
+  with prompt_lock:
+    print('\n')
+    print('--- [' + title + '] ' + ('-'*(width-(len(title)+7))))
+    print('\n' + msg + '\n')
+    print('-'*width)
+    if interactive:
+      print('Press enter to continue or Ctrl + C to abort')
+    print('-'*width)
+    print('')
+    i = input() if interactive else None
   if i:
     raise Exception('aborting due to unexpected input')
 
+# With LINCFG_FIXTURE_ROOT set (see lincfg_bench.py), absolute paths resolve
+# inside that directory instead, apart from the kernel's and temp files
+fixture_passthrough_prefixes = ('/proc/', '/dev/', '/tmp/')
+
 def fixpath(p):
   if desired_username and p.startswith(f'~{desired_username}/') and is_termux():
     p = '~/' + p[len(desired_username)+2:]
   if not is_termux() and '$PREFIX' in p:
     p = p.replace('$PREFIX', '')
-  return os.path.expanduser(os.path.expandvars(p))
+  p = os.path.expanduser(os.path.expandvars(p))
+  if (root := os.environ.get('LINCFG_FIXTURE_ROOT')) and os.path.isabs(p):
+    root = os.path.abspath(root)
+    if not (p + '/').startswith((root + '/',) + fixture_passthrough_prefixes):
+      p = root + p
+  return p
+
+# Files read and written through read_config/write_config are cached for the
+# run. Plain 'w' writes only update the cache and are committed atomically by
+# flush_config_cache(), which runs before any subprocess that may read them is
+# started (see FlushingPopen), at the end of the run and wherever a task needs
+# the files to actually be on disk.
+config_cache = {}
+config_cache_lock = threading.RLock()
+uncached_config_prefixes = ('/proc/', '/sys/', '/dev/', '/run/')
+
+def get_umask():
+  umask = os.umask(0o022)
+  os.umask(umask)
+  return umask
+
+config_umask = get_umask()
+
+def get_config_signature(st):
+  return (st.st_ino, st.st_mtime_ns, st.st_size)
 
 def read_config(fname, default_contents = None):
   p = fixpath(fname)
+  if p.startswith(uncached_config_prefixes):
+    try:
+      with open(p, 'r') as f:
+        return p, f.read()
+    except FileNotFoundError:
+      if default_contents is not None:
+        return p, default_contents
+      raise
+  with config_cache_lock:
+    entry = config_cache.get(p)
+    if entry and entry['dirty']:
+      return p, entry['contents']
+    try:
+      if entry and get_config_signature(os.stat(p)) == entry['signature']:
+        return p, entry['contents']
+      with open(p, 'r') as f:
+        signature = get_config_signature(os.fstat(f.fileno()))
+        contents = f.read()
+    except FileNotFoundError:
+      config_cache.pop(p, None)
+      if default_contents is not None:
+        return p, default_contents
+      raise
+    config_cache[p] = {'signature': signature, 'contents': contents,
+                       'dirty': False}
+    return p, contents
+
+def write_config(fname, contents, user = None, mode = 'w', perms = None):
+  fname = fixpath(fname)
+  if mode != 'w' or fname.startswith(uncached_config_prefixes):
+    with config_cache_lock:
+      flush_config_cache(fname)
+      config_cache.pop(fname, None)
+    makedirs(os.path.dirname(fname), user = user)
+    with open(fname, mode) as f:
+      f.write(contents if 'b' in mode else textwrap.dedent(contents))
+    if user:
+      shutil.chown(fname, user)
+    if perms is not None:
+      os.chmod(fname, perms)
+    return
+  contents = textwrap.dedent(contents)
+  with config_cache_lock:
+    entry = config_cache.get(fname)
+    if entry and entry['contents'] == contents and \
+       not entry['dirty'] and user is None and perms is None:
+      return
+    config_cache[fname] = {
+      'signature': entry and entry['signature'],
+      'contents': contents,
+      'dirty': True,
+      'user': user or (entry or {}).get('user'),
+      'perms': perms if perms is not None else (entry or {}).get('perms'),
+    }
+
+def commit_config(fname, entry):
+  makedirs(os.path.dirname(fname), user = entry['user'])
+  target = os.path.realpath(fname)
   try:
-    with open(p, 'r') as f:
-      return p, f.read()
+    st = os.stat(target)
   except FileNotFoundError:
-    if default_contents is not None:
-      return p, default_contents
+    st = None
+  fd, tmp = tempfile.mkstemp(dir = os.path.dirname(target),
+                             prefix = '.' + os.path.basename(target) + '.')
+  try:
+    with open(fd, 'w') as f:
+      f.write(entry['contents'])
+      tmp_st = os.fstat(f.fileno())
+    if st is None:
+      os.chmod(tmp, 0o666 & ~config_umask)
+    else:
+      if (st.st_uid, st.st_gid) != (tmp_st.st_uid, tmp_st.st_gid):
+        os.chown(tmp, st.st_uid, st.st_gid)
+      os.chmod(tmp, stat.S_IMODE(st.st_mode))
+    if entry['user']:
+      shutil.chown(tmp, entry['user'])
+    if entry['perms'] is not None:
+      os.chmod(tmp, entry['perms'])
+    os.replace(tmp, target)
+  except BaseException:
+    try:
+      os.remove(tmp)
+    except FileNotFoundError:
+      pass
     raise
+  entry['signature'] = get_config_signature(os.stat(target))
+  entry['dirty'] = False
 
-def write_config(fname, contents, user = None, mode = 'w', perms = None):
-  fname = fixpath(fname)
-  makedirs(os.path.dirname(fname), user = user)
-  with open(fname, mode) as f:
-    f.write(contents if 'b' in mode else textwrap.dedent(contents))
-  if user:
-    shutil.chown(fname, user)
-  if perms is not None:
-    os.chmod(fname, perms)
+def flush_config_cache(*paths):
+  paths = set(map(fixpath, paths))
+  with config_cache_lock:
+    for fname, entry in config_cache.items():
+      if entry['dirty'] and (not paths or fname in paths):
+        commit_config(fname, entry)
 
 def get_config_var(config, name):
   return (list(
@@ -6117,41 +7265,105 @@ def ensure_rc_values(path, values, user = desired_username):
   p, rc = read_config(path, default_contents = '')
   return ensure_rc_values_with_cache(p, rc, values, user = user)
 
-def rc_regex_escape(txt):
-  for c in '$[]().*+\\':
-    txt = txt.replace(c, '\\'+c)
-  return txt
+# Formatting preserving model of a KDE rc file. Sections are looked up by their
+# full header (e.g. '[AC][Display]') and keys through a per-section index, so a
+# batch of edits never rescans the text and text() serializes it once.
+class RcDocument(object):
+  def __init__(self, rc):
+    self.trailing_newline = rc.endswith('\n') or not rc
+    self.sections = [self.make_section(None)]
+    self.section_index = {}
+    for line in rc.splitlines():
+      header = line.strip()
+      if header.startswith('[') and header.endswith(']'):
+        section = self.make_section(header, line)
+        self.sections.append(section)
+        self.section_index.setdefault(header, section)
+      else:
+        self.sections[-1]['lines'].append(line)
+    for section in self.sections:
+      self.index_keys(section)
+
+  @staticmethod
+  def make_section(header, header_line = None, new = False):
+    return {'header': header, 'header_line': header_line,
+            'lines': [], 'keys': {}, 'new': new}
+
+  @staticmethod
+  def index_keys(section):
+    section['keys'] = {}
+    for idx, line in enumerate(section['lines']):
+      key, d, _ = line.partition('=')
+      if d and not line.lstrip().startswith(('#', ';')):
+        section['keys'].setdefault(key.strip(), []).append(idx)
+
+  def headers(self):
+    return [i['header'] for i in self.sections if i['header'] is not None]
+
+  def get_section(self, header, create = False):
+    section = self.section_index.get(header)
+    if section is None and create:
+      section = self.make_section(header, header, new = True)
+      self.sections.append(section)
+      self.section_index[header] = section
+    return section
+
+  def get(self, header, key):
+    section = self.section_index.get(header)
+    if section is None or key not in section['keys']:
+      return None
+    return section['lines'][section['keys'][key][-1]].partition('=')[2].strip()
+
+  def find_sections(self, key, value):
+    return [section['header']
+            for section in self.sections
+            for idx in section['keys'].get(key, ())
+            if section['lines'][idx] == f'{key}={value}']
+
+  def set(self, header, key, value):
+    section = self.get_section(header, create = True)
+    line = f'{key}={value}'
+    if idxs := section['keys'].get(key):
+      for idx in idxs:
+        section['lines'][idx] = line
+      return
+    lines = section['lines']
+    end = len(lines)
+    while end > 0 and not lines[end-1].strip():
+      end -= 1
+    lines.insert(end, line)
+    section['keys'][key] = [end]
+
+  # Replaces every line of the section while keeping its trailing blank lines
+  def set_section(self, header, lines):
+    section = self.get_section(header, create = True)
+    end = len(section['lines'])
+    while end > 0 and not section['lines'][end-1].strip():
+      end -= 1
+    section['lines'] = list(lines) + section['lines'][end:]
+    self.index_keys(section)
+
+  def text(self):
+    out = []
+    for section in self.sections:
+      if section['new'] and out and out[-1].strip():
+        out.append('')
+      if section['header_line'] is not None:
+        out.append(section['header_line'])
+      out += section['lines']
+    return '\n'.join(out) + ('\n' if out and self.trailing_newline else '')
 
 def ensure_rc_values_with_cache(path, rc, values, user = desired_username):
-  original_rc = rc
+  doc = RcDocument(rc)
   for section, key, value in values:
-    ekey = rc_regex_escape(key)
-    evalue = rc_regex_escape(value)
-    if old_rc_section := get_rc_section(rc, section):
-      new_rc_section = old_rc_section
-    else:
-      new_rc_section = section
-    if f'{key}={value}' in new_rc_section:
-      continue
-    if '\n'+key+'=' not in new_rc_section:
-      new_rc_section += f'\n{key}={value}'
-    else:
-      new_rc_section = re.sub(
-        f'\n{ekey}=.*',
-        f'\n{key}={value}',
-        new_rc_section,
-      )
-    if old_rc_section:
-      rc = rc.replace(old_rc_section, new_rc_section)
-    else:
-      rc += '\n' + new_rc_section + '\n'
-  if rc != original_rc:
-    write_config(path, rc, user = user)
+    doc.set(section, key, value)
+  if (desired_rc := doc.text()) != rc:
+    write_config(path, desired_rc, user = user)
 
 @functools.cache
 def get_os_name():
   try:
-    with open('/etc/os-release', 'r') as f:
+    with open(fixpath('/etc/os-release'), 'r') as f:
       osr = f.read()
   except FileNotFoundError:
     return None
@@ -6185,30 +7397,228 @@ def is_termux():
 # the output of sha256sum.
 # Does NOT check permissions or other metadata
 # Account for that when auditing code and updating hashes in this script
-def hash_path(path):
+hash_path_cache_name = 'hash_path_cache.json'
+hash_path_cache_length = 256
+hash_path_mmap_threshold = 4194304 # 4 MB
+hash_path_read_jobs = 4
+hash_path_read_ahead = 16
+
+@functools.cache
+def load_hash_path_cache():
+  return load_lincfg_json(hash_path_cache_name, {})
+
+# New digests only update the in-memory cache, which main() saves once at the
+# end of the run
+hash_path_cache_lock = threading.Lock()
+hash_path_cache_updates = set()
+
+def update_hash_path_cache(key, digest):
+  with hash_path_cache_lock:
+    cache = load_hash_path_cache()
+    cache.pop(key, None)
+    cache[key] = digest
+    for old_key in list(cache)[:-hash_path_cache_length]:
+      del cache[old_key]
+    hash_path_cache_updates.add(key)
+
+def save_hash_path_cache():
+  with hash_path_cache_lock:
+    if hash_path_cache_updates:
+      save_lincfg_json(hash_path_cache_name, load_hash_path_cache())
+      hash_path_cache_updates.clear()
+
+def read_file_for_hash(path, size):
+  if size >= hash_path_mmap_threshold:
+    return None
+  with open(path, 'rb') as f:
+    return f.read()
+
+def update_hash_from_file(hash, path, data):
+  if data is not None:
+    return hash.update(data)
+  with open(path, 'rb') as f:
+    try:
+      with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+        return hash.update(m)
+    except (ValueError, OSError):
+      pass
+    while buf := f.read(4194304): # 4 MB
+      hash.update(buf)
+
+# The digest is a single sha256 stream over the sorted tree so it can't be
+# split across threads without changing audited hashes. Instead small files are
+# read ahead on a thread pool while the caller hashes (hashlib releases the GIL
+# on large buffers), big files are hashed straight from mmap and the result for
+# an unchanged tree is reused from a cache keyed on every entry's stat.
+def hash_path(path, cache = True):
+  import concurrent.futures
   hash = hashlib.sha256()
   paths = [('D' if os.path.isdir(path) else 'F', path)]
   for root, dirs, files in os.walk(path):
     for kind, names in (('D', dirs), ('F', files)):
       for i in names:
         paths.append((kind, os.path.join(root, i)))
+  entries = []
+  manifest = hashlib.sha256()
   for kind, ipath in sorted(paths, key=lambda i: i[1]):
     assert ipath.startswith(path)
     epath = ipath[len(path):]
-    if len(epath) != 0 and kind != 'F':
-      hash.update((str(len(epath))+kind+epath).encode('utf8'))
-    if kind == 'F':
-      with open(ipath, 'rb') as f:
-        while True:
-          buf = f.read(4194304) # 4 MB
-          if not buf: break
-          hash.update(buf)
-  return hash.hexdigest()
+    st = os.stat(ipath) if kind == 'F' else None
+    entries.append((kind, ipath, epath, st))
+    manifest.update(repr((kind, epath, st and (
+      st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+    ))).encode('utf8'))
+  key = manifest.hexdigest()
+  if cache and (digest := load_hash_path_cache().get(key)):
+    return digest
+  with concurrent.futures.ThreadPoolExecutor(hash_path_read_jobs) as ex:
+    reads = {}
+    files = [(ipath, st.st_size) for kind, ipath, _, st in entries if kind == 'F']
+    for ipath, size in files[:hash_path_read_ahead]:
+      reads[ipath] = ex.submit(read_file_for_hash, ipath, size)
+    next_read = hash_path_read_ahead
+    for kind, ipath, epath, st in entries:
+      if len(epath) != 0 and kind != 'F':
+        hash.update((str(len(epath))+kind+epath).encode('utf8'))
+      if kind == 'F':
+        if next_read < len(files):
+          reads[files[next_read][0]] = ex.submit(read_file_for_hash,
+                                                 *files[next_read])
+          next_read += 1
+        update_hash_from_file(hash, ipath, reads.pop(ipath).result())
+  digest = hash.hexdigest()
+  if cache:
+    update_hash_path_cache(key, digest)
+  return digest
+
+# Small HTTP client shared by the PyPI checks. Connections are kept alive per
+# thread and host, and text fetched through http_get_text() is revalidated
+# against its last ETag/Last-Modified so an unchanged page costs a 304.
+http_cache_name = 'http_cache.json'
+http_cache_lock = threading.Lock()
+http_connections = threading.local()
+http_redirect_limit = 10
+http_jobs = 4
+
+def get_pypi_index_url():
+  return os.environ.get('LINCFG_PYPI_INDEX_URL', 'https://pypi.org/simple/')
+
+def get_http_connection(scheme, netloc, fresh = False):
+  import http.client
+  conns = http_connections.__dict__.setdefault('conns', {})
+  if fresh or (conn := conns.get((scheme, netloc))) is None:
+    if scheme == 'https':
+      conn = http.client.HTTPSConnection(netloc, timeout = 60)
+    else:
+      conn = http.client.HTTPConnection(netloc, timeout = 60)
+    conns[(scheme, netloc)] = conn
+  return conn
+
+def http_request(url, headers = {}):
+  import http.client
+  for _ in range(http_redirect_limit):
+    u = urllib.parse.urlsplit(url)
+    path = (u.path or '/') + ('?' + u.query if u.query else '')
+    for fresh in (False, True):
+      conn = get_http_connection(u.scheme, u.netloc, fresh)
+      try:
+        conn.request('GET', path, headers = {'User-Agent': 'lincfg'} | headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        break
+      except (http.client.RemoteDisconnected, BrokenPipeError,
+              ConnectionResetError):
+        conn.close()
+        if fresh:
+          raise
+    if resp.status in (301, 302, 303, 307, 308):
+      url = urllib.parse.urljoin(url, resp.getheader('Location'))
+      continue
+    if resp.status >= 400:
+      raise Exception('HTTP error', resp.status, url)
+    return resp.status, resp.headers, body
+  raise Exception('Too many redirects', url)
 
-def ensure_python_package(src_url, hash, user=None):
+@functools.cache
+def load_http_cache():
+  return load_lincfg_json(http_cache_name, {})
+
+def http_get_text(url):
+  headers = {}
+  if cached := load_http_cache().get(url):
+    etag, modified, text = cached
+    if etag:
+      headers['If-None-Match'] = etag
+    if modified:
+      headers['If-Modified-Since'] = modified
+  status, resp_headers, body = http_request(url, headers)
+  if status == 304 and cached:
+    return text
+  text = body.decode()
+  etag = resp_headers.get('ETag')
+  modified = resp_headers.get('Last-Modified')
+  if etag or modified:
+    with http_cache_lock:
+      http_cache = load_http_cache()
+      http_cache[url] = [etag, modified, text]
+      save_lincfg_json(http_cache_name, http_cache)
+  return text
+
+@functools.cache
+def get_pypi_latest_version(pkgname):
+  return re.findall(r'\-([\d\.]+)\-',
+                    http_get_text(get_pypi_index_url() + pkgname))[-1]
+
+def parse_python_package_url(src_url):
   fname = src_url.split('/')[-1]
   pkgname = '-'.join(fname.split('-')[:-1])
   pkgver = fname.split('-')[-1][:-7]
+  return fname, pkgname, pkgver
+
+# Verified source tarballs are kept by their audited hash, so reinstalls and
+# moves to a new python version don't download them again
+python_package_cache_name = 'python_packages'
+
+def get_cached_python_package(hash):
+  path = os.path.join(get_lincfg_data_path(python_package_cache_name),
+                      hash + '.tar.gz')
+  try:
+    with open(path, 'rb') as f:
+      if hashlib.file_digest(f, 'sha256').hexdigest() == hash:
+        return path
+  except FileNotFoundError:
+    pass
+
+def fetch_python_package(src_url, hash):
+  if path := get_cached_python_package(hash):
+    return path
+  body = http_request(src_url)[2]
+  if hashlib.sha256(body).hexdigest() != hash:
+    raise Exception('hash mismatch', parse_python_package_url(src_url)[1])
+  makedirs(cache_dir := get_lincfg_data_path(python_package_cache_name))
+  fd, tpath = tempfile.mkstemp(dir = cache_dir)
+  with os.fdopen(fd, 'wb') as f:
+    f.write(body)
+  os.replace(tpath, path := os.path.join(cache_dir, hash + '.tar.gz'))
+  return path
+
+def install_python_package(src_url, hash, pkgroot, user = None):
+  pkgname = parse_python_package_url(src_url)[1]
+  ttar = fetch_python_package(src_url, hash)
+  troot = tempfile.mkdtemp(prefix='pypkg_')
+  try:
+    subprocess.run(['tar', 'xzf', ttar, '-C', troot])
+    xdir = sorted(filter(os.path.isdir,map(lambda i: os.path.join(troot, i),
+                  os.listdir(troot))))[0]
+    os.makedirs(pkgroot, exist_ok=True)
+    shutil.move(os.path.join(xdir, pkgname.replace('-','_')), pkgroot)
+  finally:
+    shutil.rmtree(troot)
+  if user:
+    subprocess.run(['chown', '-R', user+':', pkgroot])
+
+def ensure_python_package(src_url, hash, user=None):
+  fname, pkgname, pkgver = parse_python_package_url(src_url)
   if user:
     cmd = ('runuser', '-u'+user, '--',
            'python', '-c' 'import site;print(site.getusersitepackages())')
@@ -6218,63 +7628,90 @@ def ensure_python_package(src_url, hash, user=None):
   else:
     pkgroot = site.getsitepackages()[0]
   pkgdir = os.path.join(pkgroot, pkgname.replace('-','_'))
-  latest_version = re.findall(r'\-([\d\.]+)\-',
-                              urllib.request.urlopen('https://pypi.org/simple/'+pkgname)
-                               .read().decode())[-1]
+  latest_version = get_pypi_latest_version(pkgname)
   if pkgver != latest_version:
     alert(f'While checking {fname} found a newer version: {latest_version}',
            'Update this script with the new url and hashes after auditing them.')
   if not os.path.exists(pkgdir):
-    troot = tempfile.mkdtemp(prefix='pypkg_')
-    ttar = os.path.join(troot, fname)
-    subprocess.run(['curl', '-L', '-o', ttar, src_url])
-    if hash_path(ttar) != hash:
-      raise Exception('hash mismatch', pkgname)
-    subprocess.run(['tar', 'xzf', ttar, '-C', troot])
-    xdir = sorted(filter(os.path.isdir,map(lambda i: os.path.join(troot, i),
-                  os.listdir(troot))))[0]
-    os.makedirs(pkgroot, exist_ok=True)
-    shutil.move(os.path.join(xdir, pkgname.replace('-','_')), pkgroot)
-    if user:
-      subprocess.run(['chown', '-R', user+':', pkgroot])
+    install_python_package(src_url, hash, pkgroot, user)
 
 apk_cache_dir = '/var/cache/apk'
 
-def restore_file_from_package(pkgname, fpath):
+# Which cached package file a restored member came from, along with the
+# installed "name version" it was recorded for. While that version is still
+# installed later restores of the member skip the download and cache scan.
+package_member_index_name = 'package_member_index.json'
+
+@functools.cache
+def load_package_member_index():
+  return load_lincfg_json(package_member_index_name, {})
+
+def find_cached_package(pkgname):
   if is_arch_linux():
     subprocess.run(['pacman', '-Sw', '--noconfirm', pkgname])
     conf = {i[0].strip():i[1].split() for i in
             map(lambda i: i.split(':'),
             subprocess.run(['pacman', '-v'], check=False, capture_output=True)
               .stdout.decode().splitlines())}
-    matching_packages = set()
-    for cache_dir in conf['Cache Dirs']:
-      for i in os.listdir(cache_dir):
-        if not i.endswith('.tar.zst'):
-          continue
-        if '-'.join(i.split('-')[:-3]) == pkgname:
-          matching_packages.add(os.path.join(cache_dir, i))
-    pkgpath = sorted(matching_packages, key=os.path.getmtime)[-1]
-    tdir = tempfile.mkdtemp(prefix='restore_pkg_'+pkgname+'_')
-    tarpath = os.path.join(tdir, 'pkg.tar')
-    subprocess.run(['unzstd', '-d', pkgpath, '-o', tarpath])
-    subprocess.run(['tar', 'xf', tarpath, '-C', tdir])
-    src = os.path.join(tdir, os.path.abspath(fpath)[1:])
-    shutil.move(src, fpath)
-  elif is_postmarketos():
-    raise NotImplementedError()
-    subprocess.run(['apk', 'fetch', pkgname])
-    # NB unfinished
-    for cache_dir in os.listdir(apk_cache_dir):
-      for i in os.listdir(cache_dir):
-        if not i.endswith('.apk'):
-          continue
-        if '-'.join(i.split('-')[:-3]) == pkgname:
-          matching_packages.add(os.path.join(cache_dir, i))
+    cache_dirs = conf['Cache Dirs']
+    suffix, name_parts = '.tar.zst', 3
   else:
+    makedirs(apk_cache_dir)
+    subprocess.run(['apk', 'fetch', '-o', apk_cache_dir, pkgname])
+    cache_dirs = [apk_cache_dir]
+    suffix, name_parts = '.apk', 2
+  matching_packages = set()
+  for cache_dir in cache_dirs:
+    for i in os.listdir(cache_dir):
+      if not i.endswith(suffix):
+        continue
+      if '-'.join(i.split('-')[:-name_parts]) == pkgname:
+        matching_packages.add(os.path.join(cache_dir, i))
+  return sorted(matching_packages, key=os.path.getmtime)[-1]
+
+def find_tar_member(tar, member):
+  for info in tar:
+    if os.path.normpath(info.name) != member:
+      continue
+    if not info.isfile():
+      raise Exception('Not a regular file in package', member)
+    return info, tar.extractfile(info).read()
+  raise FileNotFoundError(member)
+
+# Pacman packages are streamed through unzstd and apk packages, a few gzip
+# streams back to back, through gzip. Either way reading stops at the member.
+def read_package_member(pkgpath, member):
+  if pkgpath.endswith('.apk'):
+    import gzip
+    with gzip.open(pkgpath) as f, \
+         tarfile.open(fileobj = f, mode = 'r|', ignore_zeros = True) as tar:
+      return find_tar_member(tar, member)
+  proc = subprocess.Popen(['unzstd', '-c', pkgpath], stdout = subprocess.PIPE)
+  try:
+    with tarfile.open(fileobj = proc.stdout, mode = 'r|') as tar:
+      return find_tar_member(tar, member)
+  finally:
+    proc.stdout.close()
+    proc.kill()
+    proc.wait()
+
+def restore_file_from_package(pkgname, fpath):
+  if not (is_arch_linux() or is_postmarketos()):
     print('ERROR: restore_file_from_package not implemented for this OS yet!!!')
     raise NotImplementedError()
-
+  member = os.path.abspath(fpath)[1:]
+  installed = [i for i in get_installed_packages() if i.split(' ')[0] == pkgname]
+  installed = installed[0] if installed else None
+  index = load_package_member_index()
+  pkgpath, recorded_for = index.get(member, (None, None))
+  if not (pkgpath and recorded_for == installed and os.path.isfile(pkgpath)):
+    pkgpath = find_cached_package(pkgname)
+    index[member] = [pkgpath, installed]
+    save_lincfg_json(package_member_index_name, index)
+  info, contents = read_package_member(pkgpath, member)
+  write_config(fpath, contents, mode = 'wb', perms = stat.S_IMODE(info.mode))
+
+@run_cached('flatpaks')
 def get_installed_flatpaks():
   installed_flatpaks = set()
   r = subprocess.check_output(['flatpak', 'list', '--columns=application,ref'])
@@ -6287,7 +7724,12 @@ def get_installed_flatpaks():
       installed_flatpaks.add(last_ref)
       installed_flatpaks.add(ref)
     last_flatpak, last_ref = flatpak, ref
-  return installed_flatpaks
+  return frozenset(installed_flatpaks)
+
+@run_cached('flatpaks')
+def get_flatpak_runtimes():
+  return frozenset(subprocess.check_output(
+    ['flatpak', 'list', '--app', '--columns=runtime']).decode().splitlines())
 
 def makedirs(path, user = None, mode = 0o755):
   dirs = []
@@ -6360,8 +7802,67 @@ def has_at_least_one_file(path):
   except NotADirectoryError:
     return True
 
+pacman_local_db_path = '/var/lib/pacman/local'
+known_pacman_local_db_versions = ('9',)
+
+def strip_pacman_dep_version(dep):
+  return re.split('[<>=]', dep, maxsplit = 1)[0]
+
+@run_cached('packages')
+def load_pacman_local_db(root, signature):
+  db = {}
+  for entry in os.scandir(root):
+    if not entry.is_dir():
+      continue
+    p = {'depends': [], 'provides': [], 'required_by': set()}
+    key = None
+    with open(os.path.join(entry.path, 'desc'), 'r') as f:
+      for line in f.read().splitlines():
+        if line.startswith('%') and line.endswith('%'):
+          key = line[1:-1]
+        elif not line:
+          key = None
+        elif key in ('NAME', 'VERSION'):
+          p[key.lower()] = line
+        elif key in ('DEPENDS', 'PROVIDES'):
+          p[key.lower()].append(line)
+    db[p['name']] = p
+  providers = {}
+  for name, p in db.items():
+    providers.setdefault(name, set()).add(name)
+    for i in p['provides']:
+      providers.setdefault(strip_pacman_dep_version(i), set()).add(name)
+  for name, p in db.items():
+    for dep in p['depends']:
+      for provider in providers.get(strip_pacman_dep_version(dep), ()):
+        db[provider]['required_by'].add(name)
+  return db
+
+# Returns None if the local db can't be read natively so callers can fall back
+# to parsing pacman's output
+def get_pacman_local_db():
+  root = fixpath(pacman_local_db_path)
+  try:
+    with open(os.path.join(root, 'ALPM_DB_VERSION'), 'r') as f:
+      db_version = f.read().strip()
+    st = os.stat(root)
+  except OSError:
+    return None
+  if db_version not in known_pacman_local_db_versions:
+    return None
+  return load_pacman_local_db(root, (st.st_ino, st.st_mtime_ns))
+
 def get_installed_packages(include_version = True):
-  if is_arch_linux():
+  packages = list(query_installed_packages())
+  if not include_version:
+    packages = [p.split()[0] for p in packages]
+  return packages
+
+@run_cached('packages')
+def query_installed_packages():
+  if is_arch_linux() and (db := get_pacman_local_db()) is not None:
+    packages = [name + ' ' + db[name]['version'] for name in sorted(db)]
+  elif is_arch_linux():
     proc = subprocess.run(shlex.split('pacman -Q'), capture_output = True)
     packages = proc.stdout.decode().splitlines()
   elif is_postmarketos():
@@ -6378,11 +7879,9 @@ def get_installed_packages(include_version = True):
     ]
   else:
     raise NotImplementedError()
-  if not include_version:
-    packages = [p.split()[0] for p in packages]
-  return packages
+  return tuple(packages)
 
-@functools.cache
+@run_cached('packages')
 def which(name):
   return shutil.which(name)
 
@@ -6414,9 +7913,13 @@ def get_id():
 def is_recovery():
   return 'recover' in get_hostname().lower()
 
+implied_flags = set()
+
 def flags(name):
   a = '--'+name
   s = {k:v for k,v,_ in flag_def}[a][1:]
+  if name in implied_flags:
+    return True
   for arg in sys.argv:
     if arg == a:
       return True
@@ -6426,7 +7929,109 @@ def flags(name):
           return True
   return False
 
+def flag_value(name):
+  a = '--'+name
+  for idx, arg in enumerate(sys.argv):
+    if arg.startswith(a + '='):
+      return arg[len(a)+1:]
+    if arg == a and idx + 1 < len(sys.argv):
+      return sys.argv[idx + 1]
+  return None
+
+# Fleet hosts come from the lincfg_fleet_hosts secret or LINCFG_FLEET_HOSTS,
+# either a list or comma separated, as ssh destinations. Each host gets this
+# script over the ssh session's stdin and runs it with --fleet-report, which
+# ends the output with a JSON result line. LINCFG_SSH replaces the ssh command.
+fleet_result_marker = 'LINCFG_FLEET_RESULT '
+fleet_results_name = 'fleet_results.json'
+fleet_remote_path = '~/.cache/lincfg_fleet.py'
+default_fleet_jobs = 4
+
+def get_fleet_hosts():
+  hosts = try_get_secret('lincfg_fleet_hosts') or []
+  if isinstance(hosts, str):
+    hosts = hosts.split(',')
+  hosts = [h.strip() for h in hosts if h.strip()]
+  for host in hosts:
+    if host.startswith('-'):
+      raise ValueError('Invalid fleet host: {}'.format(repr(host)))
+  return hosts
+
+def get_fleet_jobs():
+  if jobs := os.environ.get('LINCFG_FLEET_JOBS', '').strip():
+    return max(1, int(jobs))
+  return default_fleet_jobs
+
+def get_fleet_ssh():
+  if ssh := os.environ.get('LINCFG_SSH', '').strip():
+    return shlex.split(ssh)
+  return ['ssh', '-o', 'BatchMode=yes']
+
+# The script is uploaded over its own connection so the run itself gets no
+# stdin, which alert() then treats as non-interactive
+def run_fleet_host(host, args):
+  ssh = get_fleet_ssh()
+  start = time.perf_counter()
+  with open(__file__, 'rb') as f:
+    upload = subprocess.run(ssh + ['--', host, f'mkdir -p ~/.cache && '
+                                               f'cat > {fleet_remote_path}'],
+                            stdin = f, capture_output = True)
+  if upload.returncode != 0:
+    for line in (upload.stdout + upload.stderr).decode(errors = 'replace').splitlines():
+      print(f'[{host}] ' + line, flush = True)
+    return {
+      'host': host,
+      'returncode': upload.returncode,
+      'wall': time.perf_counter() - start,
+      'status': 'upload failed',
+    }
+  remote = (f'exec "$(command -v python3 || command -v python)" '
+            f'{fleet_remote_path} ' + shlex.join(args))
+  proc = subprocess.Popen(ssh + ['--', host, remote],
+                          stdin = subprocess.DEVNULL,
+                          stdout = subprocess.PIPE,
+                          stderr = subprocess.STDOUT)
+  result = {'status': 'unknown'}
+  for line in proc.stdout:
+    line = line.decode(errors = 'replace')
+    if line.startswith(fleet_result_marker):
+      try:
+        result = json.loads(line[len(fleet_result_marker):])
+        continue
+      except json.JSONDecodeError:
+        pass
+    print(f'[{host}] ' + line, end = '', flush = True)
+  proc.wait()
+  return {
+    'host': host,
+    'returncode': proc.returncode,
+    'wall': time.perf_counter() - start,
+  } | result
+
+def run_fleet():
+  import concurrent.futures
+  if not (hosts := get_fleet_hosts()):
+    raise Exception('No fleet hosts, set lincfg_fleet_hosts or LINCFG_FLEET_HOSTS')
+  if flags('interact') or flags('undesired'):
+    raise Exception('--fleet runs without a terminal, drop --interact/--undesired')
+  args = [i for i in sys.argv[1:] if i != '--fleet'] + ['--fleet-report']
+  with concurrent.futures.ThreadPoolExecutor(get_fleet_jobs()) as ex:
+    results = list(ex.map(lambda host: run_fleet_host(host, args), hosts))
+  save_lincfg_json(fleet_results_name,
+                   {'time': cached_time(), 'args': args, 'hosts': results})
+  print('\nFleet results:')
+  for r in results:
+    slowest = sorted(r.get('tasks', ()), key = lambda i: -i['wall'])[:3]
+    print(f'  {r['host'][:30]:<30} {r['status']:<8} rc {r['returncode']:<4} '
+          f'{r['wall']:>8.1f}s  ' +
+          ', '.join((f'{t['name']} {t['wall']:.1f}s' for t in slowest)))
+  print('Details saved to', path)
+  if any((r['returncode'] != 0 for r in results)):
+    sys.exit(1)
+
 def main():
+  startup_times['main'] = time.perf_counter()
+  startup_times['process_age'] = get_process_age()
   try:
     with open('/proc/' + str(os.getpid()) + '/comm', 'w') as f:
       f.write('lincfg')
@@ -6444,10 +8049,359 @@ def main():
       print('  ' + s + (' ' * max(1, (desired_column - len(s)))) + d[-1])
     return
 
+  if flags('fleet'):
+    return run_fleet()
+
+  status = 'failed'
+  try:
+    run_tasks(select_tasks(tasks))
+    flush_config_cache()
+    status = 'ok'
+  except SystemExit:
+    status = None
+    raise
+  finally:
+    flush_config_cache()
+    save_hash_path_cache()
+    if status == 'ok':
+      record_managed_file_fingerprints()
+    if flags('incremental'):
+      print_managed_file_report()
+    if status:
+      previous = record_task_profiles(status)
+      if flags('profile'):
+        print_profile_report(previous)
+    if flags('startup-profile'):
+      print_startup_profile()
+    if status and flags('fleet-report'):
+      print(fleet_result_marker + json.dumps({
+        'status': status,
+        'hostname': get_hostname(),
+        'tasks': task_profiles,
+      }), flush = True)
+
+# Selections never drop the startup tasks and always pull in the prereqs (and
+# network tasks named by after_network) of every selected task
+task_presets = {
+  'quick': {'skip': ('network', 'packages', 'security', 'maintenance')},
+  'full': {},
+  'scan': {'only': ('security',), 'flags': ('scan',)},
+}
+
+def get_startup_task_indices(tasks):
+  startup = set()
   for idx, task in enumerate(tasks):
-    print(f'[Task {idx+1}] {task.__name__}', flush = True)
-    # if idx > 42: breakpoint()
-    task()
+    if task not in startup_tasks:
+      break
+    startup.add(idx)
+  return startup
+
+def get_task_costs():
+  walls = {}
+  runs = [i for i in load_profile_history() if i.get('status') == 'ok']
+  for run in runs[-profile_compared_runs:]:
+    for t in run['tasks']:
+      walls.setdefault(t['name'], []).append(t['wall'])
+  return {name: sum(w) / len(w) for name, w in walls.items()}
+
+def select_tasks(tasks):
+  only = [i for i in (flag_value('only') or '').split(',') if i]
+  skip = [i for i in (flag_value('skip') or '').split(',') if i]
+  if preset := flag_value('preset'):
+    if preset not in task_presets:
+      raise ValueError('Invalid preset: {}'.format(repr(preset)))
+    only += task_presets[preset].get('only', ())
+    skip += task_presets[preset].get('skip', ())
+    implied_flags.update(task_presets[preset].get('flags', ()))
+  if not only and not skip:
+    return tasks
+  known = {t.__name__ for t in tasks}.union(*map(get_task_tags, tasks))
+  for name in only + skip:
+    if name not in known:
+      raise ValueError('Unknown task or tag: {}'.format(repr(name)))
+  matches = lambda task, names: task.__name__ in names or \
+                                get_task_tags(task).intersection(names)
+  selected = get_startup_task_indices(tasks)
+  for idx, task in enumerate(tasks):
+    if (not only or matches(task, only)) and not matches(task, skip):
+      selected.add(idx)
+  queue = sorted(selected)
+  for idx in queue:
+    task = tasks[idx]
+    for name in prereqs.get(task, ()) + network_dependents.get(task, ()):
+      earlier = [i for i in range(idx) if tasks[i].__name__ == name]
+      if earlier and earlier[-1] not in selected:
+        selected.add(earlier[-1])
+        queue.append(earlier[-1])
+  costs = get_task_costs()
+  estimate = sum((costs.get(tasks[idx].__name__, 0) for idx in selected))
+  print(f'Running {len(selected)} of {len(tasks)} tasks '
+        f'(about {estimate:.0f}s based on previous runs)')
+  return [tasks[idx] for idx in sorted(selected)]
+
+def is_overlapped(task, overlap):
+  return overlap and task in network_tasks
+
+def get_task_deps(tasks, overlap = False):
+  deps = []
+  last_idx = {}
+  barrier = None
+  since_barrier = []
+  startup = get_startup_task_indices(tasks)
+  for idx, task in enumerate(tasks):
+    if is_overlapped(task, overlap):
+      d = set(startup)
+    else:
+      d = set() if barrier is None else {barrier}
+    if task in prereqs:
+      for name in prereqs[task]:
+        if name not in last_idx:
+          raise RuntimeError(f'Unknown or later prereq {name} for {task.__name__}')
+        d.add(last_idx[name])
+      if not is_overlapped(task, overlap):
+        since_barrier.append(idx)
+    else:
+      d.update(since_barrier)
+      barrier = idx
+      since_barrier = []
+    for name in network_dependents.get(task, ()):
+      if name not in last_idx:
+        raise RuntimeError(f'Unknown or later network task {name} for {task.__name__}')
+      d.add(last_idx[name])
+    deps.append(d)
+    last_idx[task.__name__] = idx
+  return deps
+
+default_task_jobs = 4
+
+def get_task_jobs():
+  if not flags('parallel'):
+    return 1
+  if jobs := os.environ.get('LINCFG_JOBS', '').strip():
+    return max(1, int(jobs))
+  return default_task_jobs
+
+profile_history_name = 'profile_history.json'
+profile_history_length = 30
+profile_compared_runs = 5
+profile_report_length = 15
+profile_regression_ratio = 1.5
+profile_regression_min_seconds = 0.5
+
+task_profiles = []
+task_profile_state = threading.local()
+
+def read_proc_io():
+  try:
+    with open('/proc/self/io', 'r') as f:
+      return {k: int(v) for k, _, v in
+              (l.partition(': ') for l in f.read().splitlines())}
+  except (OSError, ValueError):
+    return {}
+
+def get_children_cpu_time():
+  ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return ru.ru_utime + ru.ru_stime
+
+# NB: RUSAGE_CHILDREN and /proc/self/io are process wide so child CPU time and
+#     I/O are only exact per task without --parallel
+def instrument_subprocess_call(f):
+  @functools.wraps(f)
+  def wrapper(*args, **kwargs):
+    profile = getattr(task_profile_state, 'profile', None)
+    if profile is None or getattr(task_profile_state, 'in_call', False):
+      return f(*args, **kwargs)
+    task_profile_state.in_call = True
+    cpu = get_children_cpu_time()
+    start = time.perf_counter()
+    try:
+      return f(*args, **kwargs)
+    finally:
+      profile['procs'] += 1
+      profile['subprocess_wall'] += time.perf_counter() - start
+      profile['child_cpu'] += get_children_cpu_time() - cpu
+      task_profile_state.in_call = False
+  return wrapper
+
+for i in ('run', 'check_call', 'check_output'):
+  if not hasattr(getattr(subprocess, i), '__wrapped__'):
+    setattr(subprocess, i, instrument_subprocess_call(getattr(subprocess, i)))
+
+# Commands which only query package, account or session state, or only read
+# the files named on their command line, and so never see the files lincfg
+# manages. Anything else may read them and gets the pending writes committed
+# first.
+config_blind_commands = (
+  ('pacman', '-Q'), ('pacman', '-Qi'), ('pacman', '-Sw'), ('pacman', '-v'),
+  ('apk', 'list'), ('apk', 'dot'), ('apk', 'fetch'), ('rpm', '--query'),
+  ('flatpak', 'list'), ('passwd', '--status'), ('loginctl',), ('lsblk',),
+  ('arch-audit',), ('xz',), ('unzstd',),
+)
+
+def reads_managed_configs(args):
+  if isinstance(args, (str, bytes, os.PathLike)):
+    args = shlex.split(os.fsdecode(args))
+  args = [os.fsdecode(i) for i in args]
+  if not args:
+    return True
+  args[0] = os.path.basename(args[0])
+  return not any((tuple(args[:len(i)]) == i for i in config_blind_commands))
+
+# subprocess.run, check_call and check_output all start their process through
+# subprocess.Popen, so this covers them as well as direct Popen callers
+class FlushingPopen(subprocess.Popen):
+  flushes_config_cache = True
+
+  def __init__(self, args, *pargs, **kwargs):
+    if reads_managed_configs(args):
+      flush_config_cache()
+    super().__init__(args, *pargs, **kwargs)
+
+if not getattr(subprocess.Popen, 'flushes_config_cache', False):
+  subprocess.Popen = FlushingPopen
+
+def run_task(idx, task):
+  print(f'[Task {idx+1}] {task.__name__}', flush = True)
+  startup_times.setdefault('first_task', (task.__name__, time.perf_counter()))
+  profile = {
+    'name': task.__name__,
+    'index': idx + 1,
+    'procs': 0,
+    'subprocess_wall': 0.0,
+    'child_cpu': 0.0,
+  }
+  task_profile_state.profile = profile
+  io = read_proc_io()
+  start = time.perf_counter()
+  try:
+    if task in interactive_tasks:
+      with prompt_lock:
+        task()
+    else:
+      task()
+  finally:
+    startup_times.setdefault('first_task_done', time.perf_counter())
+    profile['wall'] = time.perf_counter() - start
+    end_io = read_proc_io()
+    profile['read_bytes'] = end_io.get('rchar', 0) - io.get('rchar', 0)
+    profile['written_bytes'] = end_io.get('wchar', 0) - io.get('wchar', 0)
+    profile['read_calls'] = end_io.get('syscr', 0) - io.get('syscr', 0)
+    profile['write_calls'] = end_io.get('syscw', 0) - io.get('syscw', 0)
+    task_profile_state.profile = None
+    task_profiles.append(profile)
+
+def get_profile_run_key():
+  return ' '.join(sorted((i for i in sys.argv[1:] if i.startswith('-')
+                          and i not in ('--profile', '-P'))))
+
+def load_profile_history():
+  return load_lincfg_json(profile_history_name, [])
+
+def record_task_profiles(status):
+  history = load_profile_history()
+  previous = [i for i in history if i.get('key') == get_profile_run_key()]
+  history.append({
+    'time': cached_time(),
+    'key': get_profile_run_key(),
+    'status': status,
+    'tasks': task_profiles,
+  })
+  save_lincfg_json(profile_history_name, history[-profile_history_length:])
+  return previous[-profile_compared_runs:]
+
+# Averages are keyed on the task name alone so adding or reordering tasks
+# doesn't break the comparison with earlier runs
+def print_profile_report(previous):
+  averages = {}
+  for run in previous:
+    for t in run['tasks']:
+      averages.setdefault(t['name'], []).append(t['wall'])
+  print('\nSlowest tasks (compared to the average of the last',
+        len(previous), 'similar run(s)):')
+  print(f'  {'Task':<50} {'Wall':>8} {'Avg':>8} {'Procs':>5} '
+        f'{'ChildCPU':>8} {'Read':>9} {'Written':>9}')
+  for t in sorted(task_profiles, key = lambda i: -i['wall'])[:profile_report_length]:
+    past = averages.get(t['name'])
+    avg = sum(past) / len(past) if past else None
+    regressed = (avg is not None and
+                 t['wall'] > avg * profile_regression_ratio and
+                 t['wall'] - avg > profile_regression_min_seconds)
+    print(f'  {t['name'][:50]:<50} {t['wall']:>7.2f}s ' +
+          (f'{avg:>7.2f}s ' if avg is not None else f'{'-':>8} ') +
+          f'{t['procs']:>5} {t['child_cpu']:>7.2f}s '
+          f'{t['read_bytes']//1024:>7}KB {t['written_bytes']//1024:>7}KB' +
+          ('  <<< REGRESSION' if regressed else ''))
+  print('')
+
+# Network tasks overlapped by --overlap don't count towards the job limit, so
+# without --parallel the local tasks still run one at a time beside them
+def run_tasks(tasks):
+  startup_times['tasks'] = time.perf_counter()
+  overlap = flags('overlap')
+  deps = get_task_deps(tasks, overlap)
+  jobs = get_task_jobs()
+  if jobs < 2 and not overlap:
+    for idx, task in enumerate(tasks):
+      # if idx > 42: breakpoint()
+      run_task(idx, task)
+    return
+  import concurrent.futures
+  pending = list(range(len(tasks)))
+  running = {}
+  done = set()
+  workers = jobs + sum((is_overlapped(task, overlap) for task in tasks))
+  with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as ex:
+    while pending or running:
+      for idx in list(pending):
+        if not is_overlapped(tasks[idx], overlap) and sum((not is_overlapped(tasks[i], overlap)
+                              for i in running.values())) >= jobs:
+          continue
+        if deps[idx] <= done:
+          pending.remove(idx)
+          running[ex.submit(run_task, idx, tasks[idx])] = idx
+      if not running:
+        raise RuntimeError('Task graph has unsatisfiable prereqs')
+      finished, _ = concurrent.futures.wait(
+        running, return_when = concurrent.futures.FIRST_COMPLETED)
+      for future in sorted(finished, key = running.get):
+        done.add(running.pop(future))
+        future.result()
+
+# Seconds since this process was started, from /proc at clock tick resolution
+def get_process_age():
+  try:
+    with open('/proc/self/stat', 'r') as f:
+      start = int(f.read().rpartition(')')[2].split()[19])
+    with open('/proc/uptime', 'r') as f:
+      uptime = float(f.read().split()[0])
+  except (OSError, ValueError, IndexError):
+    return None
+  return uptime - start / os.sysconf('SC_CLK_TCK')
+
+# NB: scripts run directly are compiled on every start, python only caches the
+#     bytecode of imported modules, so the first line is usually the largest
+def print_startup_profile():
+  t = startup_times
+  steps = []
+  if t.get('process_age') is not None:
+    steps.append(('Interpreter start and compile',
+                  t['process_age'] - (t['main'] - t['start'])))
+  steps.append(('Imports', t['imported'] - t['start']))
+  steps.append(('Module body', t['loaded'] - t['imported']))
+  steps.append(('Until main', t['main'] - t['loaded']))
+  if 'tasks' in t:
+    steps.append(('Main until the task scheduler', t['tasks'] - t['main']))
+  if 'first_task' in t:
+    name, start = t['first_task']
+    steps.append(('Scheduler until the first task', start - t['tasks']))
+    if 'first_task_done' in t:
+      steps.append((f'First task ({name})', t['first_task_done'] - start))
+  print('\nStartup profile:')
+  for name, seconds in steps:
+    print(f'  {name[:50]:<50} {max(0, seconds):>7.3f}s')
+  print('')
+
+startup_times['loaded'] = time.perf_counter()
 
 if __name__ == '__main__':
   main()
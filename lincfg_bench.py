@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# Benchmarks lincfg tasks against a synthetic root instead of the real system.
+# "make" generates a fixture root with a pacman local db, flatpak deployments,
+# large rc files and a full downloads dir, plus stub pacman, flatpak,
+# systemctl, maldet, ... commands which replay recorded outputs. "run" then
+# runs the selected tasks offline with LINCFG_FIXTURE_ROOT pointing at the
+# fixture, so every path lincfg resolves through fixpath() lands inside it,
+# and reports per-task latency and read/write syscall counts next to the
+# average of the previous runs against the same fixture.
+#
+# NB: only tasks which go through fixpath() and the stubbed commands are safe
+#     to benchmark this way, anything else still touches the real system.
+#     plasmashell and kate are stubbed so that the KDE rc tasks, which bail
+#     out when they aren't installed, run against the generated rc files
+
+import sys, os, json, random, hashlib, subprocess, shlex, time
+
+DEFAULT_PACKAGES = 2000
+DEFAULT_FLATPAKS = 80
+DEFAULT_RC_SECTIONS = 500
+DEFAULT_DOWNLOADS = 10000
+
+DESIRED_USERNAME = 'Liz'
+BENCH_HOME = '/home/bench'
+DATA_DIR = '.local/share/lincfg'
+PROFILE_HISTORY_NAME = 'profile_history.json'
+BENCH_HISTORY_NAME = 'bench_history.json'
+COMPARED_RUNS = 5
+REGRESSION_RATIO = 1.5
+REGRESSION_MIN_SECONDS = 0.05
+
+STUBBED_COMMANDS = ('pacman', 'flatpak', 'systemctl', 'maldet', 'freshclam',
+                    'rkhunter', 'lynis', 'apk', 'runuser', 'plasmashell', 'kate',
+                    'kbuildsycoca6')
+
+STUB_TEMPLATE = '''#!/bin/sh
+name="$(basename "$0")"
+key="$(printf '%s ' "$name" "$@" | sha256sum | cut -c1-16)"
+echo "$name $*" >> "$LINCFG_FIXTURE_ROOT/stub_calls.log"
+out="$LINCFG_FIXTURE_ROOT/stub_outputs/$key"
+[ -f "$out" ] && cat "$out"
+[ -f "$out.rc" ] && exit "$(cat "$out.rc")"
+exit 0
+'''
+
+def write_file(root, path, contents, mode = 0o644):
+  p = os.path.join(root, path.lstrip('/'))
+  os.makedirs(os.path.dirname(p), exist_ok = True)
+  with open(p, 'wb' if isinstance(contents, bytes) else 'w') as f:
+    f.write(contents)
+  os.chmod(p, mode)
+  return p
+
+def stub_key(args):
+  return hashlib.sha256(''.join((a + ' ' for a in args)).encode()).hexdigest()[:16]
+
+def record_stub_output(root, args, output, returncode = 0):
+  key = stub_key(args)
+  write_file(root, os.path.join('stub_outputs', key), output)
+  if returncode:
+    write_file(root, os.path.join('stub_outputs', key + '.rc'), str(returncode))
+
+def make_pacman_db(root, rng, count):
+  names = [f'benchpkg{i:05}' for i in range(count)]
+  write_file(root, '/var/lib/pacman/local/ALPM_DB_VERSION', '9\n')
+  for idx, name in enumerate(names):
+    # Mostly a DAG with the odd cycle, like real dependency trees
+    deps = set(rng.sample(names[idx+1:], min(3, len(names) - idx - 1)))
+    if idx > 0 and rng.random() < 0.01:
+      deps.add(names[rng.randrange(idx)])
+    desc = f'%NAME%\n{name}\n\n%VERSION%\n1.0-1\n\n'
+    if deps:
+      desc += '%DEPENDS%\n' + ''.join((d + '>=1.0\n' for d in sorted(deps))) + '\n'
+    write_file(root, f'/var/lib/pacman/local/{name}-1.0-1/desc', desc)
+  record_stub_output(root, ['pacman', '-Q'],
+                     ''.join((f'{name} 1.0-1\n' for name in names)))
+
+def make_flatpaks(root, rng, count):
+  apps = [f'org.lincfgbench.App{i:04}' for i in range(count)]
+  perms = ('network', 'ipc', 'x11', 'wayland', 'pulseaudio', 'dri')
+  for app in apps:
+    shared = ';'.join((p for p in ('network', 'ipc') if rng.random() < 0.7))
+    sockets = ';'.join(rng.sample(perms[2:], 2))
+    metadata = (f'[Application]\nname={app}\nruntime=org.kde.Platform/x86_64/6.8\n\n'
+                f'[Context]\nshared={shared};\nsockets={sockets};\n'
+                f'filesystems=xdg-download;home;\n\n'
+                f'[Session Bus Policy]\norg.freedesktop.Notifications=talk\n')
+    write_file(root, f'/var/lib/flatpak/app/{app}/current/active/metadata',
+               metadata)
+  record_stub_output(root, ['flatpak', 'list', '--columns=application,ref'],
+                     ''.join((f'{app} {app}/x86_64/stable\n' for app in apps)))
+  record_stub_output(root, ['flatpak', 'list', '--app', '--columns=runtime'],
+                     'org.kde.Platform/x86_64/6.8\n' * count)
+
+def make_rc_files(root, rng, sections):
+  home = f'/home/{DESIRED_USERNAME}'
+  rules = [f'[General]\ncount={sections}\nrules=' +
+           ','.join((str(i + 1) for i in range(sections))) + '\n']
+  for i in range(sections):
+    rules.append(f'\n[{i + 1}]\nDescription=Bench rule {i}\n'
+                 f'wmclass=bench{i}\nwmclassmatch=1\n'
+                 f'position={rng.randrange(1000)},{rng.randrange(1000)}\n'
+                 'positionrule=3\n')
+  write_file(root, f'{home}/.config/kwinrulesrc', ''.join(rules))
+  for name in ('kdeglobals', 'dolphinrc', 'kwinrc', 'plasmashellrc'):
+    write_file(root, f'{home}/.config/{name}', ''.join((
+      f'[Bench][Group {i}]\n' + ''.join((f'Key{j}=Value{j}\n' for j in range(10)))
+      + '\n' for i in range(sections))))
+
+def make_downloads(root, rng, count):
+  unscanned = f'/home/{DESIRED_USERNAME}/Downloads/Unscanned'
+  for i in range(count):
+    write_file(root, f'{unscanned}/download_{i:05}.bin', rng.randbytes(256))
+
+def make_fixtures(root, packages, flatpaks, rc_sections, downloads, seed):
+  rng = random.Random(seed)
+  root = os.path.abspath(root)
+  write_file(root, '/etc/os-release',
+             'NAME="Arch Linux"\nPRETTY_NAME="Arch Linux"\nID=arch\n')
+  write_file(root, '/etc/hostname', 'lincfg-bench\n')
+  for cmd in STUBBED_COMMANDS:
+    write_file(root, f'/bin/{cmd}', STUB_TEMPLATE, 0o755)
+  os.makedirs(os.path.join(root, BENCH_HOME.lstrip('/')), exist_ok = True)
+  make_pacman_db(root, rng, packages)
+  make_flatpaks(root, rng, flatpaks)
+  make_rc_files(root, rng, rc_sections)
+  make_downloads(root, rng, downloads)
+  print(f'Created fixtures in {root}: {packages} packages, {flatpaks} flatpaks, '
+        f'{rc_sections} rc sections, {downloads} downloads')
+
+def load_json(path, default):
+  try:
+    with open(path, 'r') as f:
+      return json.load(f)
+  except (OSError, json.JSONDecodeError):
+    return default
+
+def run_lincfg(root, lincfg, selected, extra_args):
+  env = dict(os.environ) | {
+    'LINCFG_FIXTURE_ROOT': root,
+    'PATH': os.path.join(root, 'bin') + os.pathsep + os.environ.get('PATH', ''),
+    'HOME': BENCH_HOME,
+  }
+  cmd = [sys.executable, lincfg, '-o', '--only', selected] + extra_args
+  log_path = os.path.join(root, 'bench.log')
+  with open(log_path, 'ab') as log:
+    log.write(('\n$ ' + shlex.join(cmd) + '\n').encode())
+    log.flush()
+    proc = subprocess.run(cmd, env = env, input = b'no\n' * 10,
+                          stdout = log, stderr = subprocess.STDOUT)
+  if proc.returncode != 0:
+    raise RuntimeError(f'lincfg failed with {proc.returncode}, see {log_path}')
+  history = load_json(os.path.join(root, BENCH_HOME.lstrip('/'), DATA_DIR,
+                                   PROFILE_HISTORY_NAME), [])
+  return history[-1]['tasks']
+
+def run_benchmark(root, selected, repeat, lincfg, extra_args):
+  root = os.path.abspath(root)
+  runs = []
+  for _ in range(repeat):
+    runs.append(run_lincfg(root, lincfg, selected, extra_args))
+  results = {}
+  for tasks in runs:
+    for t in tasks:
+      r = results.setdefault(t['name'], {'wall': [], 'procs': [],
+                                         'read_calls': [], 'write_calls': []})
+      for k in r:
+        r[k].append(t.get(k, 0))
+  results = {name: {k: sum(v) / len(v) for k, v in r.items()}
+             for name, r in results.items()}
+  history_path = os.path.join(root, BENCH_HISTORY_NAME)
+  history = load_json(history_path, [])
+  previous = [i['results'] for i in history if i['selected'] == selected]
+  history.append({'time': time.time(), 'selected': selected,
+                  'results': results})
+  with open(history_path, 'w') as f:
+    json.dump(history, f)
+  print_report(results, previous[-COMPARED_RUNS:])
+  return results
+
+def print_report(results, previous):
+  print(f'  {"Task":<50} {"Wall":>8} {"Avg":>8} {"Procs":>5} '
+        f'{"ReadCalls":>9} {"WriteCalls":>10}')
+  for name, r in sorted(results.items(), key = lambda i: -i[1]['wall']):
+    past = [p[name]['wall'] for p in previous if name in p]
+    avg = sum(past) / len(past) if past else None
+    regressed = (avg is not None and
+                 r['wall'] > avg * REGRESSION_RATIO and
+                 r['wall'] - avg > REGRESSION_MIN_SECONDS)
+    print(f'  {name[:50]:<50} {r["wall"]:>7.3f}s ' +
+          (f'{avg:>7.3f}s ' if avg is not None else f'{"-":>8} ') +
+          f'{r["procs"]:>5.0f} {r["read_calls"]:>9.0f} {r["write_calls"]:>10.0f}' +
+          ('  <<< REGRESSION' if regressed else ''))
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description = 'Benchmark lincfg tasks '
+                                   'against a synthetic fixture root')
+  sub = parser.add_subparsers(dest = 'command', required = True)
+  make = sub.add_parser('make', help = 'generate a fixture root')
+  make.add_argument('root')
+  make.add_argument('--packages', type = int, default = DEFAULT_PACKAGES)
+  make.add_argument('--flatpaks', type = int, default = DEFAULT_FLATPAKS)
+  make.add_argument('--rc-sections', type = int, default = DEFAULT_RC_SECTIONS)
+  make.add_argument('--downloads', type = int, default = DEFAULT_DOWNLOADS)
+  make.add_argument('--seed', type = int, default = 0)
+  run = sub.add_parser('run', help = 'run tasks against a fixture root')
+  run.add_argument('root')
+  run.add_argument('tasks', help = 'comma separated task names or tags')
+  run.add_argument('--repeat', type = int, default = 3)
+  run.add_argument('--lincfg', default = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'lincfg.py'))
+  # Anything unrecognised (e.g. --undesired) is passed through to lincfg
+  args, lincfg_args = parser.parse_known_args()
+  if args.command == 'make':
+    make_fixtures(args.root, args.packages, args.flatpaks, args.rc_sections,
+                  args.downloads, args.seed)
+  else:
+    run_benchmark(args.root, args.tasks, args.repeat, args.lincfg,
+                  [i for i in lincfg_args if i != '--'])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Checks the task graph lincfg builds, run with: python3 -m unittest test_lincfg
+
+import builtins, unittest, unittest.mock, inspect, io, contextlib, sys
+
+# NB: normally provided by the machine specific config lincfg runs with
+builtins.sftp_pool_remote_path = '/srv/pool'
+builtins.is_parent_pc = lambda: False
+
+import lincfg
+
+class TaskDepsTest(unittest.TestCase):
+  # With --overlap every network task should start as soon as the startup
+  # tasks and the tasks below are done, not behind a later barrier
+  expected_network_task_deps = {
+    'ensure_python_packages_updated': {'handle_python_version_updates'},
+    'check_for_out_of_date_aur_packages': {'install_or_update_packages'},
+    'ensure_maldet_installed_and_up_to_date': {'install_or_update_packages'},
+    'update_av_signatures': {'install_or_update_packages',
+                             'ensure_maldet_installed_and_up_to_date'},
+    'update_flatpaks': {'install_or_update_packages'},
+  }
+
+  def test_network_task_start_deps(self):
+    tasks = lincfg.tasks
+    names = [t.__name__ for t in tasks]
+    startup = {names[i] for i in lincfg.get_startup_task_indices(tasks)}
+    deps = lincfg.get_task_deps(tasks, overlap = True)
+    got = {names[idx]: {names[i] for i in d} - startup
+           for idx, d in enumerate(deps) if tasks[idx] in lincfg.network_tasks}
+    self.assertEqual(got, self.expected_network_task_deps)
+
+class TaskSelectionTest(unittest.TestCase):
+  def select(self, *args):
+    with unittest.mock.patch.object(sys, 'argv', ['lincfg', *args]), \
+         contextlib.redirect_stdout(io.StringIO()):
+      return lincfg.select_tasks(lincfg.tasks)
+
+  def test_every_task_is_tagged(self):
+    self.assertEqual([t.__name__ for t in lincfg.tasks
+                      if not lincfg.get_task_tags(t)], [])
+
+  # Startup tasks are never dropped, handle_init only touches the network when
+  # LINCFG_INIT_ROOT is set
+  def test_quick_preset_skips_network_tasks(self):
+    startup = lincfg.startup_tasks
+    for task in self.select('--preset', 'quick'):
+      if task in startup:
+        continue
+      self.assertNotIn('network', lincfg.get_task_tags(task), task.__name__)
+      self.assertNotIn("flags('offline')", inspect.getsource(task),
+                       task.__name__)
+
+if __name__ == '__main__':
+  unittest.main()